@@ -0,0 +1,95 @@
+"""
+Compare `SQLiteBackend` and `AsyncSQLiteBackend` under concurrent reads, then sequential writes.
+
+20 concurrent readers hit 50 cached 20KB entries 20 times each, then 200 entries are set one after the other.
+A probe task measures how long the event loop is blocked meanwhile.
+The entries are written to the app's cache database under the `bench:` namespace and cleared afterwards.
+
+Usage (from `docking-station-app`):
+    python scripts/bench_cache_backends.py
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / 'src' / 'app'))
+
+import api.schemas  # noqa: E402,F401 - the settings package is imported through the schemas, as in the app
+from api.settings.cache import AsyncSQLiteBackend, SQLiteBackend  # noqa: E402
+
+NAMESPACE = 'bench:'
+PAYLOAD = 'x' * 20_000
+ENTRIES = 50
+READERS = 20
+READS_PER_READER = 20
+WRITES = 200
+
+
+async def _probe_loop_lag(stop: asyncio.Event, lags: list[float]):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def _flush(backend):
+    if isinstance(backend, AsyncSQLiteBackend):
+        await backend.flush()
+
+
+def _percentile(values: list[float], p: float):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def bench(backend, name: str):
+    for i in range(ENTRIES):
+        await backend.set(f'{NAMESPACE}{i}', PAYLOAD, 600)
+    await _flush(backend)
+
+    stop = asyncio.Event()
+    lags: list[float] = []
+    probe = asyncio.create_task(_probe_loop_lag(stop, lags))
+    hits: list[float] = []
+
+    async def _reader(i: int):
+        for j in range(READS_PER_READER):
+            start = time.perf_counter()
+            await backend.get_with_ttl(f'{NAMESPACE}{(i + j) % ENTRIES}')
+            hits.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_reader(i) for i in range(READERS)])
+    reads_done = time.perf_counter()
+    for i in range(WRITES):
+        await backend.set(f'{NAMESPACE}w{i}', PAYLOAD, 600)
+    await _flush(backend)
+    writes_done = time.perf_counter()
+
+    stop.set()
+    await probe
+    await backend.clear(namespace=NAMESPACE)
+    await _flush(backend)
+
+    print(
+        f'{name}: '
+        f'hit p50={_percentile(hits, 0.5) * 1e3:.2f}ms p99={_percentile(hits, 0.99) * 1e3:.2f}ms, '
+        f'reads {reads_done - start:.3f}s, {WRITES} sets {writes_done - reads_done:.3f}s, '
+        f'max loop lag {max(lags) * 1e3:.0f}ms'
+    )
+
+
+async def main():
+    await bench(SQLiteBackend(), 'SQLiteBackend')
+
+    backend = AsyncSQLiteBackend()
+    try:
+        await bench(backend, 'AsyncSQLiteBackend')
+    finally:
+        await backend.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
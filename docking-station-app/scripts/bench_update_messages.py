@@ -0,0 +1,87 @@
+"""
+Measure the CPU time of running update tasks, from the worker producing their messages to the clients following them.
+
+Each stack is updated on the `UpdateScheduler` (one worker per stack) with a fake `docker compose`
+that prints 30 lines over 3 seconds, its messages appended to the task as in `_run_update_task`.
+Every task is followed by a client waiting on its messages, as the SSE and WebSocket endpoints do.
+Idle tasks should cost close to no CPU time, whatever the number of stacks.
+
+Usage (from `docking-station-app`):
+    python scripts/bench_update_messages.py [STACKS ...]
+"""
+
+import asyncio
+import sys
+import time
+from functools import partial
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / 'src' / 'app'))
+
+import api.schemas  # noqa: E402,F401 - the settings package is imported through the schemas, as in the app
+from api.services import docker as docker_services  # noqa: E402
+from api.services.update_scheduler import UpdateScheduler  # noqa: E402
+from api.task_store import TaskStoreItem  # noqa: E402
+
+LINES = 30
+LINE_INTERVAL_SECONDS = 0.1
+
+
+def _fake_compose(cmd: list[str]):
+    for i in range(LINES):
+        time.sleep(LINE_INTERVAL_SECONDS)
+        yield f'line {i + 1}/{LINES}'
+
+
+async def _fake_compose_config_files(stack_name: str):
+    return [Path('/nonexistent') / stack_name / 'docker-compose.yml']
+
+
+def _run_update(task: TaskStoreItem, stack: str):
+    docker_services.run_compose_stack_update(
+        stack_name=stack,
+        on_message=task.append_message,
+    )
+
+
+async def _follow(task: TaskStoreItem):
+    offset = 0
+    while not task.done or offset < len(task.messages):
+        await task.wait_for_messages(offset)
+        offset += len(task.messages.read(offset))
+    return offset
+
+
+async def bench(scheduler: UpdateScheduler, stacks: int):
+    scheduler.max_workers = max(scheduler.max_workers, stacks)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+    tasks = [TaskStoreItem() for _ in range(stacks)]
+    for i, task in enumerate(tasks):
+        scheduler.submit(
+            name=f'bench-{i}',
+            task=task,
+            run=partial(_run_update, stack=f'bench-{i}'),
+        )
+    messages = await asyncio.gather(*[_follow(task) for task in tasks])
+
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    errors = [task.error for task in tasks if task.error]
+    if errors:
+        raise RuntimeError(f'{len(errors)} updates failed, e.g. {errors[0]!r}')
+    return wall, cpu, sum(messages)
+
+
+async def main(stacks: list[int]):
+    docker_services.subprocess_stream_generator = _fake_compose
+    docker_services.inventory.get_compose_config_files = _fake_compose_config_files
+    scheduler = UpdateScheduler(max_workers=max(stacks))
+
+    print(f'{"stacks":>6}  {"wall":>6}  {"cpu":>6}  {"cpu per task":>12}  {"messages":>8}')
+    for n in stacks:
+        wall, cpu, messages = await bench(scheduler, n)
+        print(f'{n:>6}  {wall:>5.2f}s  {cpu:>5.2f}s  {cpu / wall / n:>11.2%}  {messages:>8}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main([int(arg) for arg in sys.argv[1:]] or [1, 4, 20]))
@@ -5,7 +5,8 @@ import logging.config
 import aiohttp
 
 from .schemas import (DockerContainer, DockerStackResponse,
-                      DockerStackUpdateRequest, DockerStackUpdateResponse)
+                      DockerStackUpdateRequest, TaskStatusResponse,
+                      UpdatePriorityEnum)
 from .settings import AutoUpdaterLogSettings, get_app_settings
 
 app_settings = get_app_settings()
@@ -14,6 +15,8 @@ logger = logging.getLogger('auto-updater')
 
 BASE_API_URL = f'http://localhost:{app_settings.server_port}/api'
 LOCK = asyncio.Semaphore(app_settings.auto_updater.max_concurrent)
+POLL_RETRY_SECONDS = 2
+MAX_UPDATE_WAIT_SECONDS = 60 * 60
 
 
 async def list_docker_stacks():
@@ -33,20 +36,43 @@ async def list_docker_stacks():
 
 async def update_service(service: DockerContainer):
     async with LOCK:
-        logger.info('Updating service:', service.service_name)
+        logger.info(f'Updating service: {service.stack_name}/{service.service_name}')
 
-        API_URL = f'{BASE_API_URL}/stacks/{service.stack_name}/{service.service_name}'
+        API_URL = f'{BASE_API_URL}/stacks/{service.stack_name}/{service.service_name}/task'
         request = DockerStackUpdateRequest(infer_envfile=True,
                                            prune_images=False,
-                                           restart_containers=True)
+                                           restart_containers=True,
+                                           priority=UpdatePriorityEnum.LOW)
         body = request.model_dump(by_alias=True)
 
         async with aiohttp.ClientSession() as session:
             async with session.post(API_URL, json=body) as resp:
-                data: dict = await resp.json()
-                resp = DockerStackUpdateResponse.model_validate(data)
-                logger.info(f'Updated service response: {service.model_dump(by_alias=True)}')
-                return resp
+                resp.raise_for_status()
+
+            # updates requested from the UI go first, follow the queued task until it finishes
+            offset = 0
+            deadline = asyncio.get_running_loop().time() + MAX_UPDATE_WAIT_SECONDS
+            while asyncio.get_running_loop().time() < deadline:
+                async with session.get(API_URL, params={'offset': offset, 'wait': 30}) as resp:
+                    if resp.ok:
+                        offset += len(await resp.json())
+                    else:
+                        # the long poll didn't hold the request, don't hammer the API
+                        await asyncio.sleep(POLL_RETRY_SECONDS)
+
+                async with session.get(f'{API_URL}/status') as resp:
+                    if resp.status == 404:
+                        logger.warning(f'Update task expired: {service.stack_name}/{service.service_name}')
+                        return None
+                    status = TaskStatusResponse.model_validate(await resp.json())
+
+                if status.state == 'finished':
+                    logger.info(f'Updated service: {service.stack_name}/{service.service_name}, '
+                                f'error: {status.error}')
+                    return status
+
+            logger.warning(f'Gave up waiting for update task: {service.stack_name}/{service.service_name}')
+            return None
 
 
 async def main():
@@ -5,22 +5,55 @@ from logging.config import dictConfig
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.exceptions import ValidationException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse
 from fastapi_cache import FastAPICache
 from pydantic import ValidationError
 
 from . import routes
-from .settings import ServerLogSettings, SQLiteBackend, cache_key_builder, get_app_settings
+from .services.engine import get_engine_client
+from .services.image_stager import ImageStager
+from .services.live_inventory import LiveInventory
+from .services.registry import get_registry_client
+from .settings import (AsyncSQLiteBackend, CacheSweeper, ServerLogSettings,
+                       TieredBackend, cache_key_builder, get_app_settings)
+from .task_store import TaskStore
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     dictConfig(ServerLogSettings().model_dump())
+    cache_backend = AsyncSQLiteBackend()
     FastAPICache.init(
-        backend=SQLiteBackend(),
+        backend=TieredBackend(
+            l2=cache_backend,
+            max_items=app_settings.server.cache_memory_max_items,
+        ),
         key_builder=cache_key_builder,
     )
+    CacheSweeper().start(
+        backend=cache_backend,
+        interval_seconds=app_settings.server.cache_sweep_interval_seconds,
+        max_rows=app_settings.server.cache_max_rows,
+        max_size_bytes=app_settings.server.cache_max_size_bytes,
+    )
+    TaskStore().start(
+        interval_seconds=app_settings.server.task_gc_interval_seconds,
+    )
+    if app_settings.server.watch_docker_events:
+        LiveInventory().start()
+    if app_settings.server.update_staging:
+        ImageStager().start(
+            interval_seconds=app_settings.server.update_staging_interval_seconds,
+        )
     yield
+    await ImageStager().stop()
+    await TaskStore().stop()
+    await LiveInventory().stop()
+    await CacheSweeper().stop()
+    await cache_backend.close()
+    await get_engine_client().close()
+    await get_registry_client().close()
 
 app_settings = get_app_settings()
 app = FastAPI(
@@ -34,6 +67,11 @@ app.add_middleware(
     allow_headers=['*'],
     allow_methods=['*'],
     allow_origins=['*'],
+    expose_headers=['ETag', 'X-Cache-Status'],
+)
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=1024,
 )
 
 
@@ -14,6 +14,11 @@ class FastAPICacheItem(SQLModel, table=True):
     key: str = Field(primary_key=True)
     data: str
     ttl_ts: int
+    accessed_ts: int = Field(
+        default=0,
+        index=True,
+        sa_column_kwargs={'server_default': '0'},
+    )
 
     created_at: datetime = Field(
         default=None,
@@ -1,8 +1,10 @@
+from .cache import router as cache_router
 from .regctl import router as regctl_router
 from .root import router as root_router
 from .stacks import router as stacks_router
 
 __all__ = [
+    'cache_router',
     'regctl_router',
     'root_router',
     'stacks_router',
@@ -0,0 +1,31 @@
+from logging import getLogger
+
+from fastapi import APIRouter
+from fastapi_cache import FastAPICache
+
+from ..schemas import CacheMaintenanceStats, CacheStats
+from ..settings import CacheSweeper, cache_counters
+
+__all__ = [
+    'router',
+]
+
+logger = getLogger(__name__)
+router = APIRouter()
+
+
+@router.get('/stats', response_model=CacheStats)
+async def get_cache_stats():
+    return CacheStats.model_validate(cache_counters, from_attributes=True)
+
+
+@router.get('/sweeper', response_model=CacheMaintenanceStats)
+async def get_cache_sweeper_stats():
+    return CacheMaintenanceStats.model_validate(CacheSweeper().stats, from_attributes=True)
+
+
+@router.delete('/tags/{tag:path}')
+async def clear_cache_tag(tag: str):
+    """drop every cached result tagged with `tag`, e.g. `stack:my-stack` or `image:postgres:16`"""
+    count = await FastAPICache.get_backend().clear(tag=tag)
+    return {'cleared': count}
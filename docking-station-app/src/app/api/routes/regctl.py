@@ -3,8 +3,9 @@ from logging import getLogger
 from fastapi import APIRouter
 from fastapi.responses import PlainTextResponse
 
-from ..schemas import RegctlImageInspect
+from ..schemas import RegctlImageInspect, RegistryRateLimit
 from ..services import regctl as regctl_services
+from ..services.registry_scheduler import get_registry_scheduler
 from ..settings import get_app_settings
 
 __all__ = [
@@ -32,3 +33,8 @@ async def get_image_inspect(tag: str, no_cache: bool = False):
         no_cache=no_cache,
         reraise=True,
     )
+
+
+@router.get('/ratelimits', response_model=list[RegistryRateLimit])
+async def list_registry_rate_limits():
+    return get_registry_scheduler().list_budgets()
@@ -1,10 +1,11 @@
 from itertools import chain
 
-from fastapi import APIRouter, status
+from fastapi import APIRouter, Request, status
 
 from .. import routes
 from ..schemas import DockerStack, DockerStackRootModel, GetStatsResponse
-from ..settings import AppSettings, get_app_settings
+from ..settings import AppSettings, etag_response, get_app_settings
+from .cache import router as cache_router
 from .regctl import router as regctl_router
 from .stacks import router as stacks_router
 
@@ -17,6 +18,7 @@ router = APIRouter()
 
 router.include_router(stacks_router, tags=['Stacks'], prefix='/stacks')
 router.include_router(regctl_router, tags=['Regctl'], prefix='/regctl')
+router.include_router(cache_router, tags=['Cache'], prefix='/cache')
 
 
 @router.get('',
@@ -32,7 +34,7 @@ async def get_settings():
 
 
 @router.get('/stats', tags=['Misc'], response_model=GetStatsResponse)
-async def get_stats(no_cache: bool = False):
+async def get_stats(request: Request, no_cache: bool = False):
     _stacks = await routes.stacks.list_compose_stacks(no_cache=no_cache)
     stacks = DockerStackRootModel.model_validate(_stacks)
 
@@ -52,9 +54,10 @@ async def get_stats(no_cache: bool = False):
         for service in stack.services:
             num_of_services_with_updates += int(service.has_updates)
 
-    return GetStatsResponse(
+    res = GetStatsResponse(
         num_of_services_with_updates=num_of_services_with_updates,
         num_of_services=num_of_services,
         num_of_stacks_with_updates=num_of_stacks_with_updates,
         num_of_stacks=num_of_stacks,
     )
+    return etag_response(request, res.model_dump_json(by_alias=True))
@@ -1,16 +1,29 @@
 import asyncio
+import json
+from collections import Counter
+from functools import partial
+from itertools import chain
 from logging import getLogger
-from threading import Thread
 
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import (APIRouter, Header, HTTPException, WebSocket,
+                     WebSocketDisconnect)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi_cache import FastAPICache
 
-from ..schemas import (DockerContainerResponse, DockerStackBatchUpdateRequest,
-                       DockerStackResponse, DockerStackUpdateRequest,
-                       MessageDict)
+from ..schemas import (DockerContainer, DockerContainerResponse, DockerStack,
+                       DockerStackBatchUpdateRequest,
+                       DockerStackChangesResponse, DockerStackResponse,
+                       DockerStackStageRequest, DockerStackUpdateRequest,
+                       StagedImageResponse, TaskStateEnum,
+                       TaskStatusResponse, TaskStoreStatsResponse)
 from ..services import docker as docker_services
-from ..settings import cache_key_builder, cached, get_app_settings
+from ..services.batch_update import BatchUpdate
+from ..services.image_stager import ImageStager
+from ..services.live_inventory import LiveInventory
+from ..services.revision_log import StackRevisionLog
+from ..services.update_scheduler import UpdateScheduler
+from ..settings import cache_tag, cached, get_app_settings
 from ..task_store import StoreKey, TaskStore, TaskStoreItem
 
 __all__ = [
@@ -21,10 +34,41 @@ logger = getLogger(__name__)
 app_settings = get_app_settings()
 router = APIRouter()
 task_store = TaskStore()
+live_inventory = LiveInventory()
+revision_log = StackRevisionLog()
+update_scheduler = UpdateScheduler()
+image_stager = ImageStager()
+
+SSE_KEEPALIVE_SECONDS = 15
+MAX_LONG_POLL_SECONDS = 30
+
+
+def _service_cache_tags(service: DockerContainer | None):
+    if service is None:
+        return
+    yield cache_tag('stack', service.stack_name)
+    yield cache_tag('service', service.stack_name, service.service_name)
+    if service.image.repo_tag:
+        yield cache_tag('image', service.image.repo_tag)
+
+
+def _stacks_cache_tags(stacks: list[DockerStack] | DockerStack | None):
+    """the stacks, services and image references a cached result depends on"""
+    if isinstance(stacks, DockerStack):
+        stacks = [stacks]
+    for stack in stacks or []:
+        yield cache_tag('stack', stack.name)
+        yield from chain.from_iterable(
+            _service_cache_tags(service)
+            for service in stack.services
+        )
 
 
 @router.get('', response_model=list[DockerStackResponse])
-@cached(expire=app_settings.server.cache_control_max_age_seconds)
+@cached(expire=app_settings.server.cache_control_max_age_seconds,
+        bypass=live_inventory.is_ready,
+        stale_while_revalidate=app_settings.server.cache_max_staleness_seconds,
+        tags=_stacks_cache_tags)
 async def list_compose_stacks(no_cache: bool = False, include_stopped: bool = False):
     return await docker_services.list_compose_stacks(
         no_cache=no_cache,
@@ -32,7 +76,109 @@ async def list_compose_stacks(no_cache: bool = False, include_stopped: bool = Fa
     )
 
 
+@router.get('/stream', response_class=StreamingResponse)
+async def stream_compose_stacks(no_cache: bool = False, include_stopped: bool = False):
+    """
+    NDJSON stream of `{"event": "stack", "data": DockerStackResponse}` lines, one per stack as soon as it resolves.
+    Services whose images are still `pending` on the registry are followed by
+    `{"event": "service", "data": DockerContainerResponse}` patch lines.
+    """
+
+    async def _generator():
+        async for event, data in docker_services.stream_compose_stacks(
+            include_stopped=include_stopped,
+            no_cache=no_cache,
+        ):
+            yield json.dumps({'event': event, 'data': jsonable_encoder(data)}) + '\n'
+
+    return StreamingResponse(
+        _generator(),
+        media_type='application/x-ndjson',
+        # keep the stream progressive, gzip would buffer the lines
+        headers={'Content-Encoding': 'identity'},
+    )
+
+
+@router.get('/changes', response_model=DockerStackChangesResponse)
+async def list_stack_changes(since: str | None = None):
+    """
+    Services whose status, digest, version or `hasUpdates` changed since the `since` cursor.
+    Pass the returned `cursor` on the next call, `reset` means the cursor is unknown (or missing)
+    and `services` holds every known service instead.
+    """
+
+    return await docker_services.list_stack_changes(since=since)
+
+
+@router.get('/changes/events', response_class=StreamingResponse)
+async def stream_stack_changes(since: str | None = None,
+                               last_event_id: str | None = Header(None)):
+    """Server-sent events variant of `/changes`, an event is pushed whenever a service changes"""
+
+    async def _generator():
+        cursor = last_event_id or since
+        send_empty = True
+        while True:
+            changes = await docker_services.list_stack_changes(since=cursor)
+            if send_empty or changes.reset or changes.services or changes.removed:
+                yield f'id: {changes.cursor}\nevent: changes\ndata: {changes.model_dump_json(by_alias=True)}\n\n'
+                send_empty = False
+            cursor = changes.cursor
+
+            if not await revision_log.wait(cursor, timeout=SSE_KEEPALIVE_SECONDS):
+                yield ': keep-alive\n\n'
+
+    return StreamingResponse(
+        _generator(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'Content-Encoding': 'identity',
+        },
+    )
+
+
+@router.get('/staged', response_model=list[StagedImageResponse])
+async def list_staged_images():
+    return image_stager.list_images()
+
+
+@router.post('/stage', response_model=list[StagedImageResponse])
+async def stage_images(request_body: DockerStackStageRequest | None = None):
+    """
+    Pre-pull the images of the given `stack/service`s in the background, defaults to every service with updates.
+    Updating a service whose images are all staged only recreates its containers.
+    """
+
+    return await image_stager.stage_updates(
+        services=request_body.services if request_body else None,
+    )
+
+
+@router.get('/tasks/stats', response_model=TaskStoreStatsResponse)
+async def get_task_store_stats():
+    tasks = task_store.tasks()
+    states = Counter(task.state for task in tasks)
+    return TaskStoreStatsResponse(
+        tasks=len(tasks),
+        keys=task_store.key_count,
+        queued=states[TaskStateEnum.QUEUED],
+        running=states[TaskStateEnum.RUNNING],
+        finished=states[TaskStateEnum.FINISHED],
+        messages_in_memory=sum(task.messages.in_memory for task in tasks),
+        messages_spilled=sum(task.messages.spilled for task in tasks),
+        spilled_bytes=sum(task.messages.spilled_bytes for task in tasks),
+        gc_runs=task_store.stats.runs,
+        gc_collected=task_store.stats.collected,
+        gc_last_run_at=task_store.stats.last_run_at,
+        gc_last_duration_seconds=task_store.stats.last_duration_seconds,
+    )
+
+
 @router.get('/{stack}', response_model=DockerStackResponse)
+@cached(expire=app_settings.server.cache_control_max_age_seconds,
+        stale_while_revalidate=app_settings.server.cache_max_staleness_seconds,
+        tags=_stacks_cache_tags)
 async def get_compose_stack(stack: str, no_cache: bool = False):
     try:
         return await docker_services.get_compose_stack(
@@ -48,6 +194,9 @@ async def get_compose_stack(stack: str, no_cache: bool = False):
 
 
 @router.get('/{stack}/{service}', response_model=DockerContainerResponse)
+@cached(expire=app_settings.server.cache_control_max_age_seconds,
+        stale_while_revalidate=app_settings.server.cache_max_staleness_seconds,
+        tags=_service_cache_tags)
 async def get_compose_service_container(stack: str, service: str, no_cache: bool = False):
     try:
         return await docker_services.get_compose_service_container(
@@ -73,74 +222,218 @@ async def create_compose_stack_service_update_task(stack: str, service: str, req
     )
 
 
-@router.post('/batch_update')
-async def create_compose_batch_update_task(request_body: DockerStackBatchUpdateRequest):
-
-    def _acc_messages_task(task: TaskStoreItem,
-                           message_queue: asyncio.Queue[MessageDict],
-                           main_worker: Thread):
-        while True:
-            try:
-                task.append_message(
-                    message_queue.get_nowait()
-                )
-            except asyncio.QueueEmpty:
-                if not main_worker.is_alive() and message_queue.empty():
-                    break
+def _run_update_task(task: TaskStoreItem,
+                     stack: str,
+                     services: list[str],
+                     request_body: DockerStackBatchUpdateRequest):
+    # with every image already staged, the update only recreates the containers
+    staged_images = image_stager.get_staged_images(stack, services, request_body.infer_envfile)
+    docker_services.run_compose_stack_update(
+        stack_name=stack,
+        services=services,
+        infer_envfile=request_body.infer_envfile,
+        restart_containers=request_body.restart_containers,
+        prune_images=request_body.prune_images,
+        pull=staged_images is None,
+        on_message=task.append_message,
+    )
+    if staged_images:
+        image_stager.consume(staged_images)
 
-        main_worker.join()  # re-raise any exceptions from the main worker
 
+@router.post('/batch_update')
+async def create_compose_batch_update_task(request_body: DockerStackBatchUpdateRequest):
+    tasks: dict[str, TaskStoreItem] = {}
     for stack, services in request_body.stack_services.items():
         skip = False
         for service in services:
-            if (stack, service) in task_store:
+            # finished tasks are kept around for `task_retention`, only running ones block a new update
+            if (existing := task_store.get((stack, service), None)) and existing.is_worker_alive():
                 skip = True
                 break
         if skip:
             continue
 
-        main_worker, queue = docker_services.update_compose_stack_ws(
-            stack_name=stack,
-            services=services,
-            infer_envfile=request_body.infer_envfile,
-            restart_containers=request_body.restart_containers,
-            prune_images=request_body.prune_images,
-        )
-
         task = TaskStoreItem()
-        acc_worker = Thread(target=_acc_messages_task, args=[task, queue, main_worker], daemon=True)
-        task.worker = acc_worker
-        acc_worker.start()
-
+        _refresh_stack_when_done(stack, task)
         for service in services:
             task_store[(stack, service)] = task
+        tasks[stack] = task
+
+    if len(tasks) > 1:
+        # stacks often share images, pull each of them once for the whole batch
+        BatchUpdate(request_body, tasks, update_scheduler).submit()
+        return {}
+
+    for stack, task in tasks.items():
+        services = request_body.stack_services[stack]
+        update_scheduler.submit(
+            name=f'{stack}/{",".join(services)}',
+            task=task,
+            run=partial(_run_update_task, stack=stack, services=services, request_body=request_body),
+            priority=request_body.priority,
+        )
 
     return {}
 
 
+def _task_not_found(stack: str, service: str):
+    return JSONResponse(
+        content={'detail': f"Compose stack service task '{stack}/{service}' not found"},
+        status_code=404,
+    )
+
+
+async def _clear_stack_cache(stack: str):
+    # only drop the cached results which include the updated stack
+    cache_backend = FastAPICache.get_backend()
+    await cache_backend.clear(tag=cache_tag('stack', stack))
+
+
+async def _refresh_stack(stack: str):
+    await _clear_stack_cache(stack)
+    if live_inventory.is_ready():
+        return  # the live inventory records the changes on its own
+
+    # otherwise the revision log is only fed by listings, record the updated services right away
+    try:
+        await docker_services.get_compose_stack(stack, no_cache=True)
+    except KeyError:
+        pass
+    except Exception:
+        logger.exception("Error listing compose stack '%s' after its update", stack)
+
+
+def _refresh_stack_when_done(stack: str, task: TaskStoreItem):
+    """clear the stack's cached results and record its changes once, when its update finishes (successfully or not)"""
+
+    loop = asyncio.get_running_loop()
+    task.add_done_callback(
+        # called from the update worker thread
+        lambda _: asyncio.run_coroutine_threadsafe(_refresh_stack(stack), loop)
+    )
+
+
+async def _follow_task_messages(stack: str, task: TaskStoreItem, offset: int = 0):
+    """Yield `(offset, message)` as soon as messages are appended, `(offset, None)` keep-alives while idle"""
+
+    while True:
+        has_messages = await task.wait_for_messages(offset, timeout=SSE_KEEPALIVE_SECONDS)
+        for message in task.messages.read(offset):
+            offset += 1
+            yield offset, message
+
+        if (task.done or not task.is_worker_alive()) and offset >= len(task.messages):
+            return
+        if not has_messages:
+            yield offset, None
+
+
+@router.get('/{stack}/{service}/task/status', response_model=TaskStatusResponse)
+async def get_compose_stack_service_update_task_status(stack: str, service: str):
+    if not (task := task_store.get((stack, service), None)):
+        return _task_not_found(stack, service)
+
+    return TaskStatusResponse(
+        state=task.state,
+        priority=task.priority,
+        queue_position=update_scheduler.position(task),
+        messages=len(task.messages),
+        queued_at=task.queued_at,
+        started_at=task.started_at,
+        finished_at=task.finished_at,
+        error=str(task.error) if task.error else None,
+    )
+
+
+@router.get('/{stack}/{service}/task/events', response_class=StreamingResponse)
+async def stream_compose_stack_service_update_task(stack: str,
+                                                   service: str,
+                                                   offset: int = 0,
+                                                   last_event_id: int | None = Header(None)):
+    """
+    Server-sent events variant of the task poll endpoint, every message is pushed as it arrives.
+    Each event's `id` is the offset to resume from, the stream ends with a `done` event, or an `error` event if the update failed.
+    """
+
+    if not (task := task_store.get((stack, service), None)):
+        return _task_not_found(stack, service)
+
+    async def _generator():
+        try:
+            async for next_offset, message in _follow_task_messages(stack, task, last_event_id or offset):
+                if message is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield f'id: {next_offset}\ndata: {json.dumps(message)}\n\n'
+
+        except Exception as exc:
+            logger.exception("Error occurred while streaming task thread for '%s/%s'", stack, service)
+            yield f'event: error\ndata: {json.dumps({"message": str(exc)})}\n\n'
+
+        else:
+            if task.error:
+                yield f'event: error\ndata: {json.dumps({"message": str(task.error)})}\n\n'
+            else:
+                yield 'event: done\ndata: {}\n\n'
+
+    return StreamingResponse(
+        _generator(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'Content-Encoding': 'identity',
+        },
+    )
+
+
+@router.websocket('/{stack}/{service}/task/ws')
+async def follow_compose_stack_service_update_task(websocket: WebSocket,
+                                                   stack: str,
+                                                   service: str,
+                                                   offset: int = 0):
+    """WebSocket variant of the task poll endpoint, sends every message as a JSON text frame as it arrives"""
+
+    await websocket.accept()
+    if not (task := task_store.get((stack, service), None)):
+        await websocket.close(code=4404, reason=f"Compose stack service task '{stack}/{service}' not found")
+        return
+
+    try:
+        async for _, message in _follow_task_messages(stack, task, offset):
+            if message is not None:
+                await websocket.send_json(message)
+
+    except WebSocketDisconnect:
+        return
+
+    except Exception as exc:
+        logger.exception("Error occurred while streaming task thread for '%s/%s'", stack, service)
+        await websocket.close(code=1011, reason=str(exc)[:120])
+        return
+
+    if task.error:
+        await websocket.close(code=1011, reason=str(task.error)[:120])
+    else:
+        await websocket.close()
+
+
 @router.get('/{stack}/{service}/task')
 async def poll_compose_stack_service_update_task(stack: str,
                                                  service: str,
-                                                 offset: int | None = None):
-    key: StoreKey = (stack, service)
+                                                 offset: int | None = None,
+                                                 wait: float | None = None):
+    """
+    Task messages past `offset`.
+    With `wait`, the request is held (up to 30 seconds) until new messages arrive or the task finishes.
+    """
 
-    try:
-        if not (task := task_store.get(key, None)):
-            return JSONResponse(
-                content={'detail': f"Compose stack service task '{stack}/{service}' not found"},
-                status_code=404,
-            )
-
-        if not task.is_worker_alive():
-            cache_backend = FastAPICache.get_backend()
-            cache_key, *_ = cache_key_builder(list_compose_stacks).split('(', 1)
-            await cache_backend.clear(namespace=cache_key)
+    key: StoreKey = (stack, service)
 
-            task.join()  # re-raise any exceptions from the task
+    if not (task := task_store.get(key, None)):
+        return _task_not_found(stack, service)
 
-    except Exception as _exc:
-        """ exception handling for 'task.join()' """
-        logger.exception("Error occurred while polling task thread for '%s/%s'", stack, service)
-        raise
+    if wait and task.is_worker_alive():
+        await task.wait_for_messages(offset or 0, timeout=min(wait, MAX_LONG_POLL_SECONDS))
 
-    return task.messages[offset:]
+    return task.messages.read(offset)
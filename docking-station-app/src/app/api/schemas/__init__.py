@@ -1,3 +1,4 @@
+from .cache import *
 from .common import *
 from .containers import *
 from .images import *
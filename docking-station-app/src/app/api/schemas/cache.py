@@ -0,0 +1,28 @@
+from datetime import datetime
+
+from .common import CamelCaseAliasedBaseModel
+
+__all__ = [
+    'CacheMaintenanceStats',
+    'CacheStats',
+]
+
+
+class CacheStats(CamelCaseAliasedBaseModel):
+    hits: int
+    stale_hits: int
+    misses: int
+    coalesced: int
+    in_flight: int
+    revalidating: int
+
+
+class CacheMaintenanceStats(CamelCaseAliasedBaseModel):
+    runs: int
+    purged: int
+    evicted: int
+    rows: int | None
+    size_bytes: int | None
+    last_run_at: datetime | None
+    last_duration_seconds: float | None
+    last_error: str | None
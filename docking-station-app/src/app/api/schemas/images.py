@@ -1,6 +1,7 @@
 from datetime import datetime
+from enum import StrEnum
 
-from pydantic import computed_field
+from pydantic import Field, computed_field
 
 from ..settings import get_app_settings
 from .common import AliasedBaseModel
@@ -8,6 +9,9 @@ from .common import AliasedBaseModel
 __all__ = [
     'DockerImage',
     'DockerImageResponse',
+    'StagedImage',
+    'StagedImageResponse',
+    'StagingStateEnum',
 ]
 
 app_settings = get_app_settings()
@@ -18,6 +22,7 @@ class DockerImage(AliasedBaseModel):
     created_at: datetime
     latest_update: datetime
     latest_version: str | None = None
+    pending: bool = False
     repo_local_digest: str | None
     repo_tag: str
     version: str | None = None
@@ -41,3 +46,24 @@ class DockerImage(AliasedBaseModel):
 
 class DockerImageResponse(AliasedBaseModel):
     """Alias for `DockerImage`"""
+
+
+class StagingStateEnum(StrEnum):
+    PULLING = 'pulling'
+    READY = 'ready'
+    FAILED = 'failed'
+
+
+class StagedImage(AliasedBaseModel):
+    repo_tag: str
+    state: StagingStateEnum = StagingStateEnum.PULLING
+    stacks: list[str] = Field(default_factory=list)
+    requested_at: datetime = Field(default_factory=datetime.now)
+    staged_at: datetime | None = None
+    digest: str | None = None
+    checked_at: datetime | None = None
+    error: str | None = None
+
+
+class StagedImageResponse(StagedImage):
+    """Alias for `StagedImage`"""
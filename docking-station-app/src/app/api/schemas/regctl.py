@@ -3,12 +3,13 @@ from pathlib import PurePath
 
 from pydantic import Field, field_validator
 
-from .common import AliasedBaseModel
+from .common import AliasedBaseModel, CamelCaseAliasedBaseModel
 
 __all__ = [
     'RegctlImageConfig',
     'RegctlImageHistory',
     'RegctlImageInspect',
+    'RegistryRateLimit',
 ]
 
 
@@ -47,3 +48,13 @@ class RegctlImageInspect(AliasedBaseModel):
     config: RegctlImageConfig = Field(default_factory=RegctlImageConfig)
     created: datetime
     history: list[RegctlImageHistory] = Field(default_factory=list)
+
+
+class RegistryRateLimit(CamelCaseAliasedBaseModel):
+    registry: str
+    limit: int | None = None
+    remaining: int | None = None
+    window_seconds: int | None = None
+    in_flight: int = 0
+    tokens: float = 0
+    paused_for_seconds: float = 0
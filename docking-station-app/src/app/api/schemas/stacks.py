@@ -5,12 +5,16 @@ from pydantic import BaseModel, Field, computed_field, model_validator
 
 from .common import AliasedBaseModel, CamelCaseAliasedBaseModel, IterableRootModel
 from .containers import DockerContainer
+from .tasks import UpdatePriorityEnum
 
 __all__ = [
     'DockerStack',
     'DockerStackBatchUpdateRequest',
+    'DockerStackChanges',
+    'DockerStackChangesResponse',
     'DockerStackResponse',
     'DockerStackRootModel',
+    'DockerStackStageRequest',
     'DockerStackUpdateRequest',
     'DockerStackUpdateResponse',
 ]
@@ -43,6 +47,17 @@ class DockerStack(AliasedBaseModel):
         return v
 
 
+class DockerStackChanges(AliasedBaseModel):
+    cursor: str
+    reset: bool = False
+    services: list[DockerContainer] = Field(default_factory=list)
+    removed: list[str] = Field(default_factory=list)
+
+
+class DockerStackChangesResponse(DockerStackChanges):
+    """Alias for `DockerStackChanges`"""
+
+
 class DockerStackRootModel(IterableRootModel):
     root: list[DockerStack]
 
@@ -51,6 +66,7 @@ class DockerStackUpdateRequest(CamelCaseAliasedBaseModel):
     infer_envfile: bool = True
     prune_images: bool = False
     restart_containers: bool = True
+    priority: UpdatePriorityEnum = UpdatePriorityEnum.HIGH
 
 
 class DockerStackBatchUpdateRequest(CamelCaseAliasedBaseModel):
@@ -58,6 +74,7 @@ class DockerStackBatchUpdateRequest(CamelCaseAliasedBaseModel):
     infer_envfile: bool = True
     prune_images: bool = False
     restart_containers: bool = True
+    priority: UpdatePriorityEnum = UpdatePriorityEnum.HIGH
 
     @property
     def stack_services(self) -> dict[str, list[str]]:
@@ -68,6 +85,10 @@ class DockerStackBatchUpdateRequest(CamelCaseAliasedBaseModel):
         return dict(res)
 
 
+class DockerStackStageRequest(CamelCaseAliasedBaseModel):
+    services: list[str] = Field(default_factory=list)
+
+
 class DockerStackResponse(DockerStack):
     """Alias for `DockerStack`"""
 
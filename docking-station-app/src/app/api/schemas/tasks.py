@@ -1,3 +1,5 @@
+from datetime import datetime
+from enum import StrEnum
 from typing import NotRequired, TypedDict
 
 from .common import CamelCaseAliasedBaseModel
@@ -5,9 +7,29 @@ from .common import CamelCaseAliasedBaseModel
 __all__ = [
     'MessageDict',
     'MessageDictResponse',
+    'TaskStateEnum',
+    'TaskStatusResponse',
+    'TaskStoreStatsResponse',
+    'UpdatePriorityEnum',
 ]
 
 
+class TaskStateEnum(StrEnum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+
+
+class UpdatePriorityEnum(StrEnum):
+    HIGH = 'high'
+    LOW = 'low'
+
+    @property
+    def rank(self):
+        """sort key, lower runs first"""
+        return 0 if self is self.HIGH else 1
+
+
 class MessageDict(TypedDict):
     stage: str
     message: NotRequired[None | str] = None
@@ -16,3 +38,29 @@ class MessageDict(TypedDict):
 class MessageDictResponse(CamelCaseAliasedBaseModel):
     stage: str
     message: None | str = None
+
+
+class TaskStatusResponse(CamelCaseAliasedBaseModel):
+    state: TaskStateEnum
+    priority: UpdatePriorityEnum
+    queue_position: int | None = None
+    messages: int
+    queued_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    error: str | None = None
+
+
+class TaskStoreStatsResponse(CamelCaseAliasedBaseModel):
+    tasks: int
+    keys: int
+    queued: int
+    running: int
+    finished: int
+    messages_in_memory: int
+    messages_spilled: int
+    spilled_bytes: int
+    gc_runs: int
+    gc_collected: int
+    gc_last_run_at: datetime | None = None
+    gc_last_duration_seconds: float | None = None
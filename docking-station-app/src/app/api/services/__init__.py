@@ -1,2 +1,3 @@
 from .docker import *
+from .inventory import *
 from .regctl import *
@@ -0,0 +1,188 @@
+import asyncio
+import subprocess
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from logging import getLogger
+from threading import Lock
+
+from ..schemas import DockerStackBatchUpdateRequest, MessageDict
+from ..settings import get_app_settings
+from ..task_store import TaskStoreItem
+from . import docker as docker_services
+from .image_stager import ImageStager
+from .update_scheduler import UpdateScheduler
+
+__all__ = [
+    'BatchUpdate',
+]
+
+logger = getLogger(__name__)
+app_settings = get_app_settings()
+
+
+class BatchUpdate:
+    """
+    Update of several stacks at once, sharing the image pulls between them.
+
+    The images of all of the selected services are resolved from the compose files and each of them is pulled once,
+    at most `update_max_concurrent_pulls` at a time. Afterwards every stack is queued on the `UpdateScheduler`
+    and only recreates its containers. With `prune_images`, images are pruned once, after the last stack.
+
+    Stacks whose images could not be resolved or pulled fall back to a regular `--pull always` update.
+    """
+
+    def __init__(self,
+                 request: DockerStackBatchUpdateRequest,
+                 tasks: dict[str, TaskStoreItem],
+                 scheduler: UpdateScheduler = None):
+        self.request = request
+        self.tasks = tasks
+        self.scheduler = scheduler or UpdateScheduler()
+        self.stack_services = {
+            stack: services
+            for stack, services in request.stack_services.items()
+            if stack in tasks
+        }
+        self.stager = ImageStager()
+        self._stack_images: dict[str, list[str]] = {}
+        self._lock = Lock()
+        self._remaining = len(tasks)
+
+    def submit(self):
+        for task in self.tasks.values():
+            task.priority = self.request.priority
+            task.append_message(
+                MessageDict(
+                    stage='Queued',
+                    message=f'Waiting for the images of {len(self.tasks)} stacks to be pulled',
+                )
+            )
+
+        self.scheduler.submit(
+            name=f'pull/{",".join(self.tasks)}',
+            task=TaskStoreItem(),
+            run=self._pull,
+            priority=self.request.priority,
+        )
+
+    async def _resolve_images(self):
+        """image -> the stacks using it, and the stacks whose images could not be resolved"""
+
+        images: dict[str, list[str]] = defaultdict(list)
+        unresolved: set[str] = set()
+
+        async def _task(stack: str, services: list[str]):
+            try:
+                self._stack_images[stack] = await docker_services.list_compose_images(
+                    stack_name=stack,
+                    services=services,
+                    infer_envfile=self.request.infer_envfile,
+                )
+            except Exception as exc:
+                logger.warning('Could not resolve the images of %s, it will pull its own: %s', stack, exc)
+                unresolved.add(stack)
+
+        await asyncio.gather(*[
+            _task(stack, services)
+            for stack, services in self.stack_services.items()
+        ])
+
+        # staged images that moved on upstream are pulled with the rest
+        await self.stager.revalidate(
+            image
+            for stack_images in self._stack_images.values()
+            for image in stack_images
+            if self.stager.is_ready(image)
+        )
+        for stack, stack_images in self._stack_images.items():
+            for image in stack_images:
+                if not self.stager.is_ready(image):
+                    images[image].append(stack)
+        return images, unresolved
+
+    def _send(self, stacks: list[str], message: MessageDict):
+        for stack in stacks:
+            self.tasks[stack].append_message(message)
+
+    def _pull_image(self, image: str, stacks: list[str]):
+        stage = f'docker pull {image}'
+        if app_settings.server.dryrun:
+            self._send(stacks, MessageDict(stage=stage, message='dryrun, skipped'))
+            return True
+
+        process = subprocess.Popen(
+            ['docker', 'pull', image],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        for line in process.stdout:
+            if line := line.strip():
+                self._send(stacks, MessageDict(stage=stage, message=line))
+        return process.wait() == 0
+
+    def _pull(self, _task: TaskStoreItem):
+        pulled_stacks: set[str] = set()
+        try:
+            start_t = time.monotonic()
+            images, unresolved = docker_services.run_in_new_loop(self._resolve_images())
+            logger.info('Batch update: pulling %d unique images for %d stacks',
+                        len(images), len(self.stack_services))
+
+            failed: set[str] = set(unresolved)
+            with ThreadPoolExecutor(max_workers=max(app_settings.server.update_max_concurrent_pulls, 1)) as pool:
+                results = pool.map(
+                    lambda item: (item[1], self._pull_image(*item)),
+                    images.items(),
+                )
+                for stacks, success in results:
+                    if not success:
+                        failed.update(stacks)
+
+            pulled_stacks = set(self.stack_services) - failed
+            logger.info('Batch update: pulled images in %.2f seconds, %d stacks fall back to pulling on their own',
+                        time.monotonic() - start_t, len(failed))
+
+        finally:
+            # queue the stacks even if the pulls failed, they then pull their own images
+            for stack, services in self.stack_services.items():
+                self.scheduler.submit(
+                    name=f'{stack}/{",".join(services)}',
+                    task=self.tasks[stack],
+                    run=partial(self._update_stack, stack=stack, pull=stack not in pulled_stacks),
+                    priority=self.request.priority,
+                )
+
+    def _update_stack(self, task: TaskStoreItem, stack: str, pull: bool):
+
+        def _on_message(message: MessageDict):
+            # sent below, once the batch prune (if it's this stack's turn) is done
+            if message['stage'] != 'Finished':
+                task.append_message(message)
+
+        try:
+            docker_services.run_compose_stack_update(
+                stack_name=stack,
+                services=self.stack_services[stack],
+                infer_envfile=self.request.infer_envfile,
+                restart_containers=self.request.restart_containers,
+                pull=pull,
+                on_message=_on_message,
+            )
+            self.stager.consume(self._stack_images.get(stack, []))
+
+        finally:
+            with self._lock:
+                self._remaining -= 1
+                is_last = self._remaining == 0
+
+            if is_last and self.request.prune_images:
+                docker_services.run_image_prune(on_message=task.append_message)
+
+        task.append_message(
+            MessageDict(
+                stage='Finished',
+            )
+        )
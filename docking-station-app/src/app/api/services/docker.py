@@ -1,27 +1,34 @@
 import asyncio
-from datetime import datetime
+import time
 from logging import getLogger
-from threading import Thread
+from typing import Callable, Coroutine
 
 from fastapi import HTTPException
-from python_on_whales import DockerClient, docker
-from python_on_whales.components.container.cli_wrapper import Container as WhalesContainer
+from python_on_whales import DockerClient
 from python_on_whales.components.container.cli_wrapper import DockerContainerListFilters
-from python_on_whales.components.image.cli_wrapper import Image as WhalesImage
 
-from ..schemas import DockerContainer, DockerImage, DockerStack, MessageDict
+from ..schemas import MessageDict
 from ..settings import get_app_settings
 from ..utils import subprocess_stream_generator
-from .regctl import get_image_inspect, get_image_remote_digest
+from . import inventory
+from .engine import get_engine_client
+from .live_inventory import LiveInventory
+from .revision_log import StackRevisionLog
 
 __all__ = [
+    'get_compose_files',
     'get_compose_service_container',
     'get_compose_stack',
     'get_image',
+    'list_compose_images',
     'list_compose_stacks',
+    'list_stack_changes',
+    'stream_compose_stacks',
     'list_containers',
     'list_images',
-    'update_compose_stack_ws',
+    'run_compose_stack_update',
+    'run_image_prune',
+    'run_in_new_loop',
     'update_compose_stack',
 ]
 
@@ -32,107 +39,33 @@ app_settings = get_app_settings()
 async def list_containers(filters: DockerContainerListFilters = None,
                           include_stopped: bool = False,
                           no_cache: bool = False):
-
-    async def _task(container: WhalesContainer):
-        nonlocal no_cache
-
-        res = DockerContainer(
-            id=container.id,
-            created_at=container.created,
-            uptime=datetime.now(container.state.started_at.tzinfo) - container.state.started_at,
-            image=None,
-            labels=container.config.labels,
-            name=container.name,
-            ports=container.network_settings.ports,
-            status=container.state.status,
-        )
-
-        if not res.dockingstation_enabled:
-            return None
-
-        image_tag = (container.config.image.split('@', 1)[0]
-                                           .removeprefix('registry.hub.docker.com/')
-                                           .removeprefix('library/'))
-        res.image = await get_image(
-            repository_or_tag=image_tag,
-            no_cache=no_cache,
-        )
-        return res
-
-    _containers = docker.container.list(
-        all=include_stopped,
-        filters=filters or {},
+    snapshot = await inventory.take_snapshot(
+        filters=filters,
+        include_stopped=include_stopped,
     )
-    containers = list(filter(
-        lambda x: x is not None,
-        await asyncio.gather(*[
-            _task(item)
-            for item in _containers
-        ])
-    ))
-
-    return sorted(
-        containers,
-        key=lambda x: x.created_at,
-        reverse=True,
+    return await inventory.build_containers(
+        snapshot=snapshot,
+        no_cache=no_cache,
     )
 
 
 async def list_images(repository_or_tag: str = None,
                       filters: dict[str, str] = None,
                       no_cache: bool = False):
-
-    async def _task(image: WhalesImage):
-        nonlocal no_cache
-
-        repo_local_digest = image.repo_digests[0] if image.repo_digests else None
-        repo_tag = image.repo_tags[0] if image.repo_tags else None
-        latest_update = image.created
-        image_lables = image.config.labels
-        image_inspect = None
-        version = None
-        latest_version = None
-
-        if image_lables:
-            for label in app_settings.server.possible_image_version_labels:
-                if v := image_lables.get(label, None):
-                    version = v
-                    break
-
-        if repo_local_digest:
-            if not repo_tag:
-                repo_tag = repo_local_digest.split('@', 1)[0]
-
-            if image_remote_digest := await get_image_remote_digest(repo_tag, no_cache=no_cache):
-                image_inspect = await get_image_inspect(image_remote_digest, no_cache=no_cache)
-                latest_update = image_inspect.created
-                for label in app_settings.server.possible_image_version_labels:
-                    if v := image_inspect.config.labels.get(label, None):
-                        latest_version = v
-                        break
-
-        return DockerImage(
-            id=image.id,
-            created_at=image.created,
-            latest_update=latest_update,
-            latest_version=latest_version,
-            repo_local_digest=repo_local_digest,
-            repo_tag=repo_tag,
-            version=version,
-        )
-
     clean_repository_or_tag = repository_or_tag
     for prefix in app_settings.server.python_on_whales__ignored_image_prefixes:
         clean_repository_or_tag = clean_repository_or_tag.removeprefix(prefix)
 
-    _images = docker.image.list(
+    _images = await inventory.find_images(
         repository_or_tag=clean_repository_or_tag,
-        filters=filters or {},
+        filters=filters,
     )
+    memo = inventory.ImageLookupMemo()
     images = await asyncio.gather(*[
-        _task(item)
-        for item in _images
+        inventory.build_image(item, no_cache=no_cache, memo=memo)
+        for item in _images.values()
     ])
+    memo.log_stats('list_images')
 
     return sorted(
         images,
@@ -155,40 +88,67 @@ async def get_image(repository_or_tag: str,
 async def list_compose_stacks(filters: DockerContainerListFilters = None,
                               include_stopped: bool = False,
                               no_cache: bool = False):
+    live_inventory = LiveInventory()
+    if not filters and live_inventory.is_ready():
+        if no_cache:
+            await live_inventory.refresh(no_cache=True)
+        return live_inventory.list_stacks(include_stopped=include_stopped)
+
+    snapshot = await inventory.take_snapshot(
+        filters={'label': inventory.COMPOSE_PROJECT_LABEL, **(filters or {})},
+        include_stopped=include_stopped,
+    )
+    stacks = await inventory.build_compose_stacks(
+        snapshot=snapshot,
+        no_cache=no_cache,
+    )
+    # only a complete listing tells which services are gone
+    StackRevisionLog().record(stacks, scope=None if not filters and include_stopped else ())
+    return stacks
 
-    async def _task(stack: DockerStack):
-        nonlocal include_stopped
-        nonlocal no_cache
 
-        stack.services = await list_containers(
-            filters={'label': f'com.docker.compose.project={stack.name}'},
-            include_stopped=include_stopped,
-            no_cache=no_cache,
-        )
-        return stack
+async def list_stack_changes(since: str | None = None):
+    """
+    Services changed since the `since` cursor, see `StackRevisionLog`.
 
-    _stacks = docker.compose.ls(all=include_stopped, filters=filters or {})
-    stacks = await asyncio.gather(*[
-        _task(DockerStack.model_validate(stack))
-        for stack in _stacks
-        if not app_settings.server.ignore_compose_stack_name_pattern.search(stack.name)
-    ])
-    stacks = [
-        stack
-        for stack in stacks
-        if stack.services
-    ]
+    The live inventory keeps the revision log up to date on its own, otherwise finished updates record their stack,
+    and the inventory is listed again once the last listing is older than `cache_control_max_age`.
+    """
 
-    return sorted(
-        stacks,
-        key=lambda x: x.name,
+    revision_log = StackRevisionLog()
+    if not LiveInventory().is_ready() and (
+        revision_log.updated_at is None
+        or time.monotonic() - revision_log.updated_at > app_settings.server.cache_control_max_age_seconds
+    ):
+        await list_compose_stacks(include_stopped=True)
+    return revision_log.changes(since)
+
+
+async def stream_compose_stacks(include_stopped: bool = False,
+                                no_cache: bool = False):
+    """Progressive `list_compose_stacks`, see `inventory.stream_compose_stacks`"""
+
+    live_inventory = LiveInventory()
+    if live_inventory.is_ready() and not no_cache:
+        for stack in live_inventory.list_stacks(include_stopped=include_stopped):
+            yield 'stack', stack
+        return
+
+    snapshot = await inventory.take_snapshot(
+        filters={'label': inventory.COMPOSE_PROJECT_LABEL},
+        include_stopped=include_stopped,
     )
+    async for item in inventory.stream_compose_stacks(
+        snapshot=snapshot,
+        no_cache=no_cache,
+    ):
+        yield item
 
 
 async def get_compose_stack(stack_name: str,
                             no_cache: bool = False):
     stacks = await list_compose_stacks(
-        filters={'name': stack_name},
+        filters={'label': f'{inventory.COMPOSE_PROJECT_LABEL}={stack_name}'},
         no_cache=no_cache,
     )
     if not stacks:
@@ -225,20 +185,14 @@ async def update_compose_stack(stack_name: str,
     config_files = None
     output = []
 
-    stack = next(iter(
-        docker.compose.ls(
-            filters={'name': stack_name},
-        )
-    ), None)
+    config_files = await inventory.get_compose_config_files(stack_name)
 
-    if not stack:
+    if config_files is None:
         raise HTTPException(
             status_code=404,
             detail=f'Compose stack {stack_name!r} not found',
         )
 
-    config_files = stack.config_files
-
     if infer_envfile:
         for p in config_files:
             if p.with_suffix('.env').exists():
@@ -290,12 +244,12 @@ async def update_compose_stack(stack_name: str,
 
     # success = is container running
     container_status = all(
-        container.state.running
-        for container in docker.container.list(
-            filters={'label': f'com.docker.compose.project={stack_name}'},
-            all=True,
+        container.status == 'running'
+        for container in await inventory.inspect_containers(
+            filters={'label': f'{inventory.COMPOSE_PROJECT_LABEL}={stack_name}'},
+            include_stopped=True,
         )
-        if not service_name or container.config.labels.get('com.docker.compose.service') == service_name
+        if not service_name or container.service_name == service_name
     )
 
     return {
@@ -304,49 +258,146 @@ async def update_compose_stack(stack_name: str,
     }
 
 
-def update_compose_stack_ws(stack_name: str,
-                            services: list[str] = [],
-                            infer_envfile: bool = True,
-                            restart_containers: bool = True,
-                            prune_images: bool = False):
+async def get_compose_files(stack_name: str, infer_envfile: bool = True):
+    """Returns the stack's `(config_files, env_file)`"""
 
-    async def _task(queue: asyncio.Queue[MessageDict]):
-        nonlocal stack_name
-        nonlocal services
-        nonlocal infer_envfile
-        nonlocal restart_containers
-        nonlocal prune_images
+    env_file = None
+    config_files = await inventory.get_compose_config_files(stack_name)
 
-        env_file = None
-        config_files = None
+    if config_files is None:
+        raise ValueError(f'Compose stack {stack_name!r} not found')
+
+    if infer_envfile:
+        for p in config_files:
+            if p.with_suffix('.env').exists():
+                env_file = p.with_suffix('.env')
+                break
+            if p.with_name('.env').exists():
+                env_file = p.with_name('.env')
+                break
 
-        stack = next(iter(
-            docker.compose.ls(
-                filters={'name': stack_name},
+    return config_files, env_file
+
+
+async def list_compose_images(stack_name: str,
+                              services: list[str] = [],
+                              infer_envfile: bool = True):
+    """The images the stack's compose files resolve to for the given services (`docker compose config --images`)"""
+
+    config_files, env_file = await get_compose_files(stack_name, infer_envfile)
+    config_file_cmd = ['-f', *config_files] if config_files else []
+    env_file_cmd = ['--env-file', env_file] if env_file else []
+    process = await asyncio.create_subprocess_exec(
+        'docker', 'compose',
+        *config_file_cmd,
+        *env_file_cmd,
+        'config', '--images',
+        *services,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode:
+        raise ValueError(f'docker compose config failed for {stack_name!r}: {stderr.decode().strip()}')
+
+    return sorted({
+        image
+        for line in stdout.decode().splitlines()
+        if (image := line.strip())
+    })
+
+
+async def _prune_images(on_message: Callable[[MessageDict], None]):
+    if app_settings.server.dryrun:
+        n = 50
+        for i in range(1, n + 1):
+            on_message(
+                MessageDict(
+                    stage='docker image prune',
+                    message=f'test line {i}/{n}',
+                )
+            )
+    elif app_settings.server.docker_backend.is_engine_api():
+        res = await get_engine_client().prune_images()
+        for item in res.get('ImagesDeleted') or []:
+            for action, image_id in item.items():
+                on_message(
+                    MessageDict(
+                        stage='docker image prune',
+                        message=f'{action}: {image_id}',
+                    )
+                )
+        on_message(
+            MessageDict(
+                stage='docker image prune',
+                message=f'Total reclaimed space: {res.get("SpaceReclaimed", 0)}B',
+            )
+        )
+    else:
+        stdout = subprocess_stream_generator([
+            'docker', 'image', 'prune', '-f'
+        ])
+        for line in stdout:
+            on_message(
+                MessageDict(
+                    stage='docker image prune',
+                    message=line,
+                )
             )
-        ), None)
 
-        if not stack:
-            raise ValueError(f'Compose stack {stack_name!r} not found')
 
-        config_files = stack.config_files
+def run_in_new_loop(coro: Coroutine):
+    """Run `coro` to completion in a new event loop, from a thread outside of any loop (e.g. an update worker)"""
+
+    async def _run():
+        try:
+            return await coro
+        finally:
+            # the engine client's connection pool is bound to this worker's event loop
+            await get_engine_client().close()
+
+    return asyncio.run(_run())
+
+
+def run_image_prune(on_message: Callable[[MessageDict], None] = None):
+    """Prune the dangling images in the calling thread (in a new event loop), reporting its output to `on_message`"""
+    run_in_new_loop(
+        _prune_images(on_message or (lambda _: None))
+    )
+
+
+def run_compose_stack_update(stack_name: str,
+                             services: list[str] = [],
+                             infer_envfile: bool = True,
+                             restart_containers: bool = True,
+                             prune_images: bool = False,
+                             pull: bool = True,
+                             on_message: Callable[[MessageDict], None] = None):
+    """
+    Update the stack's services in the calling thread (in a new event loop), reporting its progress to `on_message`.
+    Without `pull`, only missing images are pulled (e.g. when they were already pulled for a whole batch).
+    """
 
-        if infer_envfile:
-            for p in config_files:
-                if p.with_suffix('.env').exists():
-                    env_file = p.with_suffix('.env')
-                    break
-                if p.with_name('.env').exists():
-                    env_file = p.with_name('.env')
-                    break
+    on_message = on_message or (lambda _: None)
 
-        queue.put_nowait(
+    async def _task():
+        nonlocal stack_name
+        nonlocal services
+        nonlocal infer_envfile
+        nonlocal restart_containers
+        nonlocal prune_images
+
+        config_files, env_file = await get_compose_files(stack_name, infer_envfile)
+
+        on_message(
             MessageDict(stage='Starting')
         )
 
+        pull_policy = 'always' if pull else 'missing'
+        stage = f'docker compose up --pull {pull_policy}'
         config_file_cmd = ['-f', *config_files] if config_files else []
         env_file_cmd = ['--env-file', env_file] if env_file else []
-        pull_cmd = ['--pull', 'always'] if not app_settings.server.dryrun else []
+        pull_cmd = ['--pull', pull_policy] if not app_settings.server.dryrun else []
         stdout = subprocess_stream_generator([
             'docker', 'compose',
             *config_file_cmd,
@@ -356,9 +407,9 @@ def update_compose_stack_ws(stack_name: str,
             *services,
         ])
         for line in stdout:
-            queue.put_nowait(
+            on_message(
                 MessageDict(
-                    stage='docker compose up --pull always',
+                    stage=stage,
                     message=line,
                 )
             )
@@ -366,43 +417,21 @@ def update_compose_stack_ws(stack_name: str,
         if app_settings.server.dryrun:
             n = 50
             for i in range(1, n + 1):
-                queue.put_nowait(
+                on_message(
                     MessageDict(
-                        stage='docker compose up --pull always',
+                        stage=stage,
                         message=f'test line {i}/{n}',
                     )
                 )
                 await asyncio.sleep(0.1)
 
         if prune_images:
-            if app_settings.server.dryrun:
-                n = 50
-                for i in range(1, n + 1):
-                    queue.put_nowait(
-                        MessageDict(
-                            stage='docker image prune',
-                            message=f'test line {i}/{n}',
-                        )
-                    )
-            else:
-                stdout = subprocess_stream_generator([
-                    'docker', 'image', 'prune', '-f'
-                ])
-                for line in stdout:
-                    queue.put_nowait(
-                        MessageDict(
-                            stage='docker image prune',
-                            message=line,
-                        )
-                    )
+            await _prune_images(on_message)
 
-        await queue.put(
+        on_message(
             MessageDict(
                 stage='Finished',
             )
         )
 
-    queue: asyncio.Queue[MessageDict] = asyncio.Queue()
-    worker = Thread(target=lambda: asyncio.run(_task(queue)), daemon=True)
-    worker.start()
-    return worker, queue
+    run_in_new_loop(_task())
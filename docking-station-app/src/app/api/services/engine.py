@@ -0,0 +1,149 @@
+import asyncio
+import json
+from functools import lru_cache
+from logging import getLogger
+from weakref import WeakKeyDictionary
+
+import aiohttp
+
+from ..settings import get_app_settings
+
+__all__ = [
+    'DockerEngineClient',
+    'DockerEngineError',
+    'get_engine_client',
+]
+
+logger = getLogger(__name__)
+app_settings = get_app_settings()
+
+
+class DockerEngineError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f'Docker Engine API error ({status}): {message}')
+        self.status = status
+        self.message = message
+
+
+def _format_filters(filters: dict[str, str | list[str]] | None):
+    """Convert CLI style filters (`{'label': 'a=b'}`) to the Engine API's JSON encoded map of lists"""
+    if not filters:
+        return None
+    return json.dumps({
+        key: value if isinstance(value, list) else [value]
+        for key, value in filters.items()
+    })
+
+
+class DockerEngineClient:
+    """
+    Minimal async client for the Docker Engine API, talking directly to the daemon's unix socket.
+
+    Connections are pooled and kept alive, one pool per event loop
+    (update tasks run their own event loop in a worker thread).
+    """
+
+    def __init__(self,
+                 socket_path: str = None,
+                 max_connections: int = None,
+                 base_url: str = 'http://docker'):
+        self.socket_path = socket_path or app_settings.server.docker_socket_path
+        self.max_connections = max_connections or app_settings.server.docker_api_max_connections
+        self.base_url = base_url
+        self._sessions: WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession] = WeakKeyDictionary()
+
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop, None)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(
+                    path=self.socket_path,
+                    limit=self.max_connections,
+                    keepalive_timeout=30,
+                ),
+            )
+            self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        if session := self._sessions.pop(loop, None):
+            await session.close()
+
+    async def request(self,
+                      method: str,
+                      path: str,
+                      params: dict[str, str] = None,
+                      json_body: dict = None):
+        params = {
+            key: value
+            for key, value in (params or {}).items()
+            if value is not None
+        }
+        async with self._get_session().request(
+            method=method,
+            url=f'{self.base_url}{path}',
+            params=params,
+            json=json_body,
+        ) as response:
+            logger.debug('Docker Engine API request: %s %s -> %d', method, path, response.status)
+            if response.status >= 400:
+                try:
+                    message = (await response.json()).get('message', '')
+                except Exception:
+                    message = await response.text()
+                raise DockerEngineError(response.status, message)
+
+            if response.content_type == 'application/json':
+                return await response.json()
+            return await response.text()
+
+    async def events(self, filters: dict[str, str | list[str]] = None):
+        """Subscribe to the daemon's events stream, yielding each event as it arrives"""
+
+        async with self._get_session().get(
+            url=f'{self.base_url}/events',
+            params={'filters': _format_filters(filters)} if filters else None,
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=None),
+        ) as response:
+            if response.status >= 400:
+                raise DockerEngineError(response.status, await response.text())
+
+            async for line in response.content:
+                if line := line.strip():
+                    yield json.loads(line)
+
+    async def list_containers(self,
+                              all: bool = False,
+                              filters: dict[str, str | list[str]] = None) -> list[dict]:
+        return await self.request('GET', '/containers/json', params={
+            'all': 'true' if all else None,
+            'filters': _format_filters(filters),
+        })
+
+    async def inspect_container(self, container_id: str) -> dict:
+        return await self.request('GET', f'/containers/{container_id}/json')
+
+    async def list_images(self,
+                          reference: str = None,
+                          filters: dict[str, str | list[str]] = None) -> list[dict]:
+        filters = dict(filters or {})
+        if reference:
+            filters['reference'] = reference
+        return await self.request('GET', '/images/json', params={
+            'filters': _format_filters(filters),
+        })
+
+    async def inspect_image(self, image_id: str) -> dict:
+        return await self.request('GET', f'/images/{image_id}/json')
+
+    async def prune_images(self, filters: dict[str, str | list[str]] = None) -> dict:
+        return await self.request('POST', '/images/prune', params={
+            'filters': _format_filters(filters),
+        })
+
+
+@lru_cache(maxsize=1)
+def get_engine_client():
+    return DockerEngineClient()
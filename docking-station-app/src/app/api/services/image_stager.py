@@ -0,0 +1,247 @@
+import asyncio
+import re
+from collections import defaultdict
+from datetime import datetime
+from logging import getLogger
+from threading import Lock
+from typing import Iterable
+
+from ..schemas import DockerContainer, StagedImage, StagingStateEnum
+from ..settings import get_app_settings
+from ..utils import Singleton
+from . import docker as docker_services
+from .regctl import get_image_remote_digest
+from .registry import ImageReference
+
+__all__ = [
+    'ImageStager',
+]
+
+logger = getLogger(__name__)
+app_settings = get_app_settings()
+
+# `docker pull` reports the digest it pulled as `Digest: sha256:...`
+DIGEST_PATTERN = re.compile(r'^Digest: (sha256:[0-9a-f]+)$', re.M)
+
+
+def _image_key(repo_tag: str):
+    """`postgres:16`, `docker.io/library/postgres:16` etc. all refer to the same image"""
+    ref = ImageReference.parse(repo_tag)
+    return f'{ref.registry}/{ref.repository}:{ref.reference}'
+
+
+class ImageStager(metaclass=Singleton):
+    """
+    Pre-pulls the images of services with updates, so that updating them only recreates their containers.
+
+    Images are staged on demand and, with `update_staging` enabled, every `update_staging_interval`.
+    An update whose images are all staged skips pulling, and consumes them once it succeeds.
+
+    Staged images remember the digest they were pulled at. Staging again and running an update check it against
+    the registry, images which moved on upstream are pulled again (by the update itself, when it runs).
+    An image which wasn't checked for `update_staging_interval` is no longer considered staged.
+    """
+
+    def __init__(self):
+        self._images: dict[str, StagedImage] = {}
+        self._lock = Lock()
+        self._semaphore: asyncio.Semaphore | None = None
+        self._pulls: set[asyncio.Task] = set()
+        self._task: asyncio.Task | None = None
+        # the loop the images are staged from, the update workers revalidate them on it
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def list_images(self):
+        return sorted(self._images.values(), key=lambda x: x.repo_tag)
+
+    def is_ready(self, repo_tag: str):
+        item = self._images.get(_image_key(repo_tag), None)
+        return (
+            item is not None
+            and item.state is StagingStateEnum.READY
+            and item.checked_at is not None
+            and datetime.now() - item.checked_at <= app_settings.server.update_staging_interval
+        )
+
+    def consume(self, repo_tags: Iterable[str]):
+        with self._lock:
+            for repo_tag in repo_tags:
+                self._images.pop(_image_key(repo_tag), None)
+
+    def get_staged_images(self,
+                          stack_name: str,
+                          services: list[str],
+                          infer_envfile: bool = True):
+        """
+        Returns the stack's images if they are all staged, otherwise `None`.
+        Called from the update workers, outside of any event loop.
+        """
+
+        async def _staged_images():
+            repo_tags = await docker_services.list_compose_images(stack_name, services, infer_envfile)
+            if not repo_tags or not all(self.is_ready(repo_tag) for repo_tag in repo_tags):
+                return None
+
+            await self.revalidate(repo_tags)
+            if all(self.is_ready(repo_tag) for repo_tag in repo_tags):
+                return repo_tags
+            return None
+
+        if not self._images:
+            return None
+        try:
+            return docker_services.run_in_new_loop(_staged_images())
+        except Exception as exc:
+            logger.warning('Could not resolve the staged images of %s: %s', stack_name, exc)
+            return None
+
+    def stage(self, services: Iterable[DockerContainer]):
+        """
+        Start pulling the services' images in the background, images which are already pulling are skipped
+        and ready ones are pulled again only if their digest changed upstream.
+        """
+
+        stacks: dict[str, set[str]] = defaultdict(set)
+        for service in services:
+            if service.image and service.image.repo_tag:
+                stacks[service.image.repo_tag].add(service.stack_name)
+
+        self._loop = asyncio.get_running_loop()
+        res = []
+        with self._lock:
+            for repo_tag, stack_names in stacks.items():
+                key = _image_key(repo_tag)
+                item = self._images.get(key, None)
+                if item is None or item.state is StagingStateEnum.FAILED:
+                    item = self._images[key] = StagedImage(repo_tag=repo_tag)
+                    self._spawn(self._pull(item))
+                elif item.state is StagingStateEnum.READY:
+                    self._spawn(self._revalidate(item))
+                item.stacks = sorted({*item.stacks, *stack_names})
+                res.append(item)
+        return res
+
+    async def stage_updates(self, services: list[str] = None):
+        """Stage the images of the given `stack/service`s, defaults to every enabled service which has updates"""
+
+        stacks = await docker_services.list_compose_stacks()
+        return self.stage(
+            service
+            for stack in stacks
+            for service in stack.services
+            if (f'{stack.name}/{service.service_name}' in services
+                if services
+                else service.has_updates and service.dockingstation_enabled)
+        )
+
+    async def revalidate(self, repo_tags: Iterable[str]):
+        """
+        Check the given ready images against the registry, from any event loop (e.g. an update worker's).
+        Images whose digest changed upstream are dropped, the update about to use them pulls them itself.
+        """
+
+        keys = {_image_key(repo_tag) for repo_tag in repo_tags}
+
+        async def _revalidate():
+            items = [
+                item
+                for key in keys
+                if (item := self._images.get(key, None)) and item.state is StagingStateEnum.READY
+            ]
+            await asyncio.gather(*[
+                self._revalidate(item, restage=False)
+                for item in items
+            ])
+
+        if self._loop is None:
+            return
+        if self._loop is asyncio.get_running_loop():
+            await _revalidate()
+            return
+        # the registry client's sessions and rate limits are bound to the loop the images are staged from
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_revalidate(), self._loop))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._pulls.add(task)
+        task.add_done_callback(self._pulls.discard)
+
+    async def _revalidate(self, item: StagedImage, restage: bool = True):
+        remote_digest = await get_image_remote_digest(item.repo_tag, no_cache=True)
+        if item.state is not StagingStateEnum.READY or not remote_digest:
+            # not staged anymore, or the registry can't tell, it expires once `update_staging_interval` passes
+            return
+
+        if remote_digest.split('@', 1)[-1] == item.digest:
+            item.checked_at = datetime.now()
+            return
+
+        if not restage:
+            logger.info('Staged image %s changed upstream, it is pulled by the update', item.repo_tag)
+            self.consume([item.repo_tag])
+            return
+
+        logger.info('Staged image %s changed upstream, pulling it again', item.repo_tag)
+        item.state = StagingStateEnum.PULLING
+        item.requested_at = datetime.now()
+        self._spawn(self._pull(item))
+
+    async def _pull(self, item: StagedImage):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(max(app_settings.server.update_max_concurrent_pulls, 1))
+
+        async with self._semaphore:
+            try:
+                digest = None
+                if not app_settings.server.dryrun:
+                    process = await asyncio.create_subprocess_exec(
+                        'docker', 'pull', item.repo_tag,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                    )
+                    stdout, stderr = await process.communicate()
+                    if process.returncode:
+                        raise RuntimeError(stderr.decode().strip() or f'docker pull exited with code {process.returncode}')
+                    if match := DIGEST_PATTERN.search(stdout.decode()):
+                        digest = match.group(1)
+
+                if digest is None:
+                    remote_digest = await get_image_remote_digest(item.repo_tag)
+                    digest = remote_digest.split('@', 1)[-1] if remote_digest else None
+
+                item.digest = digest
+                item.error = None
+                item.state = StagingStateEnum.READY
+                item.staged_at = item.checked_at = datetime.now()
+                logger.info('Staged image: %s', item.repo_tag)
+
+            except Exception as exc:
+                item.state = StagingStateEnum.FAILED
+                item.error = str(exc)
+                logger.warning('Error staging image %s: %s', item.repo_tag, exc)
+
+    def start(self, interval_seconds: float):
+        if interval_seconds <= 0:
+            logger.info('Periodic image staging disabled')
+            return None
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(interval_seconds))
+        return self._task
+
+    async def stop(self):
+        for task in (self._task, *self._pulls):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+    async def _run(self, interval_seconds: float):
+        while True:
+            try:
+                staged = await self.stage_updates()
+                logger.info('Image staging: %d images with updates', len(staged))
+            except Exception:
+                logger.exception('Error staging images')
+            await asyncio.sleep(interval_seconds)
@@ -0,0 +1,676 @@
+import asyncio
+import json
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from logging import getLogger
+from pathlib import Path
+from typing import Awaitable, Callable, TypeVar
+
+from fastapi.concurrency import run_in_threadpool
+from pydantic import TypeAdapter
+from python_on_whales import docker
+from python_on_whales.components.container.cli_wrapper import DockerContainerListFilters
+from python_on_whales.utils import run
+
+from ..schemas import DockerContainer, DockerImage, DockerStack
+from ..settings import get_app_settings
+from .engine import DockerEngineError, get_engine_client
+from .regctl import get_image_inspect, get_image_manifest_digests, get_image_remote_digest
+from .registry import ImageReference
+
+__all__ = [
+    'ContainerRecord',
+    'ImageLookupMemo',
+    'ImageRecord',
+    'InventorySnapshot',
+    'build_compose_stacks',
+    'build_containers',
+    'build_image',
+    'clean_image_tag',
+    'find_images',
+    'get_compose_config_files',
+    'inspect_containers',
+    'inspect_images',
+    'is_image_up_to_date',
+    'local_image',
+    'stream_compose_stacks',
+    'take_snapshot',
+]
+
+logger = getLogger(__name__)
+app_settings = get_app_settings()
+T = TypeVar('T')
+
+COMPOSE_PROJECT_LABEL = 'com.docker.compose.project'
+COMPOSE_SERVICE_LABEL = 'com.docker.compose.service'
+COMPOSE_CONFIG_FILES_LABEL = 'com.docker.compose.project.config_files'
+COMPOSE_STATES = ('created', 'dead', 'exited', 'paused', 'restarting', 'running')
+# the states the daemon lists without `all` (`docker ps`)
+ACTIVE_STATES = ('paused', 'restarting', 'running')
+
+_datetime_adapter = TypeAdapter(datetime)
+
+
+def _parse_datetime(value: str | None):
+    if not value or value.startswith('0001-01-01'):
+        return None
+    return _datetime_adapter.validate_python(value)
+
+
+def clean_image_tag(image_ref: str):
+    """
+    Normalize a container's image reference to docker's familiar form, as listed in the image's `RepoTags`
+    (e.g. `docker.io/library/redis` -> `redis:latest`), dropping the digest.
+    """
+    ref = ImageReference.parse(image_ref.split('@', 1)[0])
+    return f'{ref.familiar_name}:{ref.tag}'
+
+
+def _compose_config_files(containers: list['ContainerRecord']):
+    return next(
+        ([Path(item) for item in label.split(',')]
+         for container in containers
+         if (label := container.labels.get(COMPOSE_CONFIG_FILES_LABEL, None))),
+        [],
+    )
+
+
+@dataclass
+class ContainerRecord:
+    id: str
+    name: str
+    created_at: datetime
+    started_at: datetime | None
+    image_id: str
+    image_ref: str
+    labels: dict[str, str] = field(default_factory=dict)
+    ports: dict[str, list[dict] | None] = field(default_factory=dict)
+    status: str = ''
+
+    @classmethod
+    def from_inspect(cls, data: dict):
+        """Build a record from a `docker container inspect` (Engine API) JSON object"""
+        config = data.get('Config') or {}
+        state = data.get('State') or {}
+        network_settings = data.get('NetworkSettings') or {}
+        return cls(
+            id=data['Id'],
+            name=data['Name'].removeprefix('/'),
+            created_at=_parse_datetime(data['Created']),
+            started_at=_parse_datetime(state.get('StartedAt')),
+            image_id=data['Image'],
+            image_ref=config.get('Image') or data['Image'],
+            labels=config.get('Labels') or {},
+            ports=network_settings.get('Ports') or {},
+            status=state.get('Status', ''),
+        )
+
+    @property
+    def stack_name(self) -> str | None:
+        return self.labels.get(COMPOSE_PROJECT_LABEL, None)
+
+    @property
+    def service_name(self) -> str | None:
+        return self.labels.get(COMPOSE_SERVICE_LABEL, None)
+
+    @property
+    def image_tag(self) -> str | None:
+        if self.image_ref.startswith('sha256:'):
+            return None
+        return clean_image_tag(self.image_ref)
+
+
+@dataclass
+class ImageRecord:
+    id: str
+    created_at: datetime
+    labels: dict[str, str] = field(default_factory=dict)
+    repo_digests: list[str] = field(default_factory=list)
+    repo_tags: list[str] = field(default_factory=list)
+
+    @classmethod
+    def from_inspect(cls, data: dict):
+        """Build a record from a `docker image inspect` (Engine API) JSON object"""
+        config = data.get('Config') or {}
+        return cls(
+            id=data['Id'],
+            created_at=_parse_datetime(data['Created']),
+            labels=config.get('Labels') or {},
+            repo_digests=data.get('RepoDigests') or [],
+            repo_tags=data.get('RepoTags') or [],
+        )
+
+    def repo_digest_for(self, repo_tag: str | None):
+        """Return the local repo digest matching `repo_tag`'s repository, falling back to the first one"""
+        if repo_tag:
+            ref = ImageReference.parse(repo_tag)
+            for item in self.repo_digests:
+                item_ref = ImageReference.parse(item)
+                if (item_ref.registry, item_ref.repository) == (ref.registry, ref.repository):
+                    return item
+        return self.repo_digests[0] if self.repo_digests else None
+
+
+@dataclass
+class InventorySnapshot:
+    """A single point-in-time view of the docker daemon's containers and the images they use"""
+
+    containers: list[ContainerRecord] = field(default_factory=list)
+    images: dict[str, ImageRecord] = field(default_factory=dict)
+
+    def group_by_stack(self):
+        res: defaultdict[str, list[ContainerRecord]] = defaultdict(list)
+        for container in self.containers:
+            if container.stack_name:
+                res[container.stack_name].append(container)
+        return dict(res)
+
+
+def _cli_inspect(object_type: str, object_ids: list[str]) -> list[dict]:
+    """Inspect all given objects using a single docker CLI call"""
+
+    if not object_ids:
+        return []
+
+    # objects might disappear between the `list` and the `inspect` calls,
+    # inspect them one by one only if the bulk call fails
+    try:
+        return json.loads(run(docker.docker_cmd + [object_type, 'inspect', *object_ids]))
+    except Exception:
+        logger.warning('Bulk %s inspect failed, falling back to per %s inspect',
+                       object_type, object_type, exc_info=True)
+
+    res = []
+    for object_id in object_ids:
+        try:
+            res.extend(json.loads(run(docker.docker_cmd + [object_type, 'inspect', object_id])))
+        except Exception:
+            continue
+    return res
+
+
+async def _engine_inspect(inspect_func, object_ids: list[str]) -> list[dict]:
+    """
+    Inspect all given objects concurrently over the engine client's connection pool.
+    Objects removed since they were listed (404) are skipped, any other error is raised.
+    """
+
+    res = await asyncio.gather(*[
+        inspect_func(object_id)
+        for object_id in object_ids
+    ], return_exceptions=True)
+    for item in res:
+        if isinstance(item, Exception) and not (isinstance(item, DockerEngineError) and item.status == 404):
+            raise item
+    return [
+        item
+        for item in res
+        if not isinstance(item, Exception)
+    ]
+
+
+async def inspect_containers(filters: DockerContainerListFilters = None,
+                             include_stopped: bool = False):
+    """
+    List and inspect all matching containers.
+
+    The `cli` backend uses exactly two docker CLI calls,
+    the `engine-api` backend uses pooled requests over the docker socket.
+    """
+
+    if app_settings.server.docker_backend.is_engine_api():
+        client = get_engine_client()
+        items = await _engine_inspect(client.inspect_container, [
+            item['Id']
+            for item in await client.list_containers(
+                all=include_stopped,
+                filters=filters,
+            )
+        ])
+
+    else:
+        def _list_and_inspect():
+            return _cli_inspect('container', [
+                container.id
+                for container in docker.container.list(
+                    all=include_stopped,
+                    filters=filters or {},
+                )
+            ])
+
+        items = await run_in_threadpool(_list_and_inspect)
+
+    return [ContainerRecord.from_inspect(item) for item in items]
+
+
+async def inspect_images(image_ids: list[str]):
+    image_ids = list(dict.fromkeys(image_ids))
+    if not image_ids:
+        return {}
+
+    if app_settings.server.docker_backend.is_engine_api():
+        items = await _engine_inspect(get_engine_client().inspect_image, image_ids)
+    else:
+        items = await run_in_threadpool(_cli_inspect, 'image', image_ids)
+
+    records = [ImageRecord.from_inspect(item) for item in items]
+    return {
+        record.id: record
+        for record in records
+    }
+
+
+async def find_images(repository_or_tag: str = None,
+                      filters: dict[str, str] = None):
+    """List and inspect all local images matching `repository_or_tag`"""
+
+    if app_settings.server.docker_backend.is_engine_api():
+        image_ids = [
+            item['Id']
+            for item in await get_engine_client().list_images(
+                reference=repository_or_tag,
+                filters=filters,
+            )
+        ]
+    else:
+        image_ids = [
+            image.id
+            for image in await run_in_threadpool(
+                docker.image.list,
+                repository_or_tag=repository_or_tag,
+                filters=filters or {},
+            )
+        ]
+
+    return await inspect_images(image_ids)
+
+
+async def take_snapshot(filters: DockerContainerListFilters = None,
+                        include_stopped: bool = False):
+    """
+    Take one container snapshot and one image snapshot of the docker daemon.
+
+    The number of docker CLI calls is constant, regardless of the number of containers.
+    """
+
+    containers = await inspect_containers(
+        filters=filters,
+        include_stopped=include_stopped,
+    )
+    images = await inspect_images([
+        container.image_id
+        for container in containers
+    ])
+    logger.debug('Inventory snapshot taken: %d containers, %d images', len(containers), len(images))
+    return InventorySnapshot(
+        containers=containers,
+        images=images,
+    )
+
+
+async def get_compose_config_files(stack_name: str) -> list[Path] | None:
+    """Return the compose stack's config files, or `None` if the stack does not exist"""
+
+    if app_settings.server.docker_backend.is_engine_api():
+        containers = await inspect_containers(
+            filters={'label': f'{COMPOSE_PROJECT_LABEL}={stack_name}'},
+            include_stopped=True,
+        )
+        if not containers:
+            return None
+        return _compose_config_files(containers)
+
+    stack = next(iter(
+        await run_in_threadpool(
+            docker.compose.ls,
+            filters={'name': stack_name},
+        )
+    ), None)
+    return stack.config_files if stack else None
+
+
+class ImageLookupMemo:
+    """
+    Per-refresh memo of image lookups.
+
+    Each distinct lookup (local image, remote digest, remote inspect) runs exactly once,
+    every other caller awaits and shares the same result.
+    """
+
+    def __init__(self):
+        self.requested = 0
+        self._lookups: dict[tuple, asyncio.Future] = {}
+
+    @property
+    def resolved(self):
+        return len(self._lookups)
+
+    def lookup(self, key: tuple, factory: Callable[[], Awaitable[T]]) -> Awaitable[T]:
+        self.requested += 1
+        if key not in self._lookups:
+            self._lookups[key] = asyncio.ensure_future(factory())
+        return self._lookups[key]
+
+    def cancel(self):
+        for lookup in self._lookups.values():
+            lookup.cancel()
+
+    def log_stats(self, name: str):
+        if self.requested:
+            logger.debug('%s: %d image lookups, %d distinct (dedup ratio %.1fx)',
+                         name, self.requested, self.resolved, self.requested / max(self.resolved, 1))
+
+
+async def is_image_up_to_date(image: ImageRecord, image_remote_digest: str):
+    """
+    Check whether the remote digest is already present locally, without fetching the remote image config.
+
+    The local repo digest is usually the manifest list's digest, but it can also be one of its
+    platform manifests (e.g. when pulled by digest), in which case the manifest list is consulted.
+    """
+
+    local_digests = {
+        item.split('@', 1)[-1]
+        for item in image.repo_digests
+    }
+    remote_digest = image_remote_digest.split('@', 1)[-1]
+    if remote_digest in local_digests:
+        return True
+
+    platform_digests = await get_image_manifest_digests(image_remote_digest)
+    return bool(local_digests.intersection(platform_digests or []))
+
+
+def _image_version(labels: dict[str, str] | None):
+    for label in app_settings.server.possible_image_version_labels:
+        if v := (labels or {}).get(label, None):
+            return v
+    return None
+
+
+def _image_repo_tag(image: ImageRecord, repo_tag: str | None):
+    if repo_tag:
+        # the daemon's spelling of the tag, as the registry lookups and homepage links expect it
+        ref = ImageReference.parse(repo_tag)
+        repo_tag = next(
+            (item for item in image.repo_tags if ImageReference.parse(item) == ref),
+            clean_image_tag(repo_tag),
+        )
+    repo_local_digest = image.repo_digest_for(repo_tag)
+    repo_tag = repo_tag or (image.repo_tags[0] if image.repo_tags else None)
+    if repo_local_digest and not repo_tag:
+        repo_tag = repo_local_digest.split('@', 1)[0]
+    return repo_tag, repo_local_digest
+
+
+def local_image(image: ImageRecord, repo_tag: str | None = None, pending: bool = False):
+    """The local half of `build_image`, without registry data. `pending` marks it as waiting on its registry lookups"""
+
+    repo_tag, repo_local_digest = _image_repo_tag(image, repo_tag)
+    return DockerImage(
+        id=image.id,
+        created_at=image.created_at,
+        latest_update=image.created_at,
+        pending=pending,
+        repo_local_digest=repo_local_digest,
+        repo_tag=repo_tag,
+        version=_image_version(image.labels),
+    )
+
+
+async def build_image(image: ImageRecord,
+                      repo_tag: str | None = None,
+                      no_cache: bool = False,
+                      memo: ImageLookupMemo = None):
+    memo = memo or ImageLookupMemo()
+    repo_tag, repo_local_digest = _image_repo_tag(image, repo_tag)
+    latest_update = image.created_at
+    image_inspect = None
+    version = _image_version(image.labels)
+    latest_version = None
+
+    if repo_local_digest:
+        image_remote_digest = await memo.lookup(
+            ('remote_digest', repo_tag),
+            lambda: get_image_remote_digest(repo_tag, no_cache=no_cache),
+        )
+        if (
+            image_remote_digest
+            and app_settings.server.update_detection.is_digest()
+            and await is_image_up_to_date(image, image_remote_digest)
+        ):
+            latest_version = version
+
+        elif image_remote_digest:
+            image_inspect = await memo.lookup(
+                ('remote_inspect', image_remote_digest),
+                lambda: get_image_inspect(image_remote_digest, no_cache=no_cache),
+            )
+            latest_update = image_inspect.created
+            latest_version = _image_version(image_inspect.config.labels)
+
+    return DockerImage(
+        id=image.id,
+        created_at=image.created_at,
+        latest_update=latest_update,
+        latest_version=latest_version,
+        repo_local_digest=repo_local_digest,
+        repo_tag=repo_tag,
+        version=version,
+    )
+
+
+def _lookup_container_image(snapshot: InventorySnapshot,
+                            container: ContainerRecord,
+                            memo: ImageLookupMemo,
+                            no_cache: bool = False):
+    return memo.lookup(
+        ('image', container.image_id, container.image_tag),
+        lambda: build_image(
+            image=snapshot.images[container.image_id],
+            repo_tag=container.image_tag,
+            no_cache=no_cache,
+            memo=memo,
+        ),
+    )
+
+
+def _build_container(container: ContainerRecord, image: DockerImage):
+    started_at = container.started_at or container.created_at
+    return DockerContainer(
+        id=container.id,
+        created_at=container.created_at,
+        uptime=datetime.now(started_at.tzinfo) - started_at,
+        image=image,
+        labels=container.labels,
+        name=container.name,
+        ports=container.ports,
+        status=container.status,
+    )
+
+
+def _build_stack(stack_name: str,
+                 containers: list[ContainerRecord],
+                 services: list[DockerContainer]):
+    states = [container.status for container in containers]
+    return DockerStack(
+        name=stack_name,
+        config_files=_compose_config_files(containers),
+        services=services,
+        **{state: states.count(state) for state in COMPOSE_STATES},
+    )
+
+
+def _compose_stacks_containers(snapshot: InventorySnapshot):
+    return {
+        stack_name: containers
+        for stack_name, containers in snapshot.group_by_stack().items()
+        if not app_settings.server.ignore_compose_stack_name_pattern.search(stack_name)
+    }
+
+
+async def build_containers(snapshot: InventorySnapshot,
+                           containers: list[ContainerRecord] = None,
+                           no_cache: bool = False,
+                           memo: ImageLookupMemo = None):
+    """
+    Join `containers` (defaults to all of the snapshot's containers) with the snapshot's images.
+
+    Each distinct image is resolved exactly once (per `memo`) and shared by all containers using it.
+    """
+
+    log_memo_stats = memo is None
+    memo = memo or ImageLookupMemo()
+    containers = [
+        container
+        for container in (snapshot.containers if containers is None else containers)
+        if container.image_id in snapshot.images
+    ]
+    images = await asyncio.gather(*[
+        _lookup_container_image(snapshot, container, memo, no_cache=no_cache)
+        for container in containers
+    ])
+    if log_memo_stats:
+        memo.log_stats('build_containers')
+
+    res: list[DockerContainer] = []
+    for container, image in zip(containers, images):
+        item = _build_container(container, image)
+        if item.dockingstation_enabled:
+            res.append(item)
+
+    return sorted(
+        res,
+        key=lambda x: x.created_at,
+        reverse=True,
+    )
+
+
+async def build_compose_stacks(snapshot: InventorySnapshot,
+                               no_cache: bool = False,
+                               memo: ImageLookupMemo = None):
+    """Build the compose stacks and their services from a single inventory snapshot"""
+
+    stacks_containers = _compose_stacks_containers(snapshot)
+    services = await build_containers(
+        snapshot=snapshot,
+        containers=[
+            container
+            for containers in stacks_containers.values()
+            for container in containers
+        ],
+        no_cache=no_cache,
+        memo=memo,
+    )
+
+    stacks_services: defaultdict[str, list[DockerContainer]] = defaultdict(list)
+    for service in services:
+        stacks_services[service.stack_name].append(service)
+
+    stacks: list[DockerStack] = []
+    for stack_name, containers in stacks_containers.items():
+        if not stacks_services[stack_name]:
+            continue
+        stacks.append(
+            _build_stack(stack_name, containers, stacks_services[stack_name])
+        )
+
+    return sorted(
+        stacks,
+        key=lambda x: x.name,
+    )
+
+
+async def stream_compose_stacks(snapshot: InventorySnapshot,
+                                no_cache: bool = False,
+                                grace_seconds: float = 0.5):
+    """
+    Progressive `build_compose_stacks`.
+
+    Yields `('stack', DockerStack)` for each stack as soon as its images resolve, or once `grace_seconds` passed.
+    Images still waiting on the registry at that point are marked as `pending`,
+    and each of their services is followed by a `('service', DockerContainer)` patch once they resolve,
+    or without their registry data once they fail.
+    """
+
+    memo = ImageLookupMemo()
+    queue: asyncio.Queue[tuple[str, DockerStack | DockerContainer] | None] = asyncio.Queue()
+    deadline = asyncio.get_running_loop().time() + grace_seconds
+
+    async def _stack_task(stack_name: str, containers: list[ContainerRecord]):
+        containers = [
+            container
+            for container in containers
+            if container.image_id in snapshot.images
+        ]
+        if not containers:
+            return
+
+        lookups = {
+            container.id: _lookup_container_image(snapshot, container, memo, no_cache=no_cache)
+            for container in containers
+        }
+        await asyncio.wait(
+            set(lookups.values()),
+            timeout=max(deadline - asyncio.get_running_loop().time(), 0),
+        )
+
+        def _image(container: ContainerRecord):
+            lookup = lookups[container.id]
+            if not lookup.done():
+                return local_image(snapshot.images[container.image_id], container.image_tag, pending=True)
+            if lookup.exception():
+                # already failed, patching it would only repeat the local image
+                return local_image(snapshot.images[container.image_id], container.image_tag)
+            return lookup.result()
+
+        services = sorted(
+            [
+                item
+                for container in containers
+                if (item := _build_container(container, _image(container))).dockingstation_enabled
+            ],
+            key=lambda x: x.created_at,
+            reverse=True,
+        )
+        if not services:
+            return
+        await queue.put(('stack', _build_stack(stack_name, containers, services)))
+
+        async def _patch(container: ContainerRecord):
+            try:
+                image = await lookups[container.id]
+            except Exception:
+                logger.exception('Error resolving image %s of %s/%s',
+                                 container.image_ref, stack_name, container.service_name)
+                # the client waits on a patch for each pending service, send it without the registry data
+                image = local_image(snapshot.images[container.image_id], container.image_tag)
+            await queue.put(('service', _build_container(container, image)))
+
+        containers_by_id = {container.id: container for container in containers}
+        await asyncio.gather(*[
+            _patch(containers_by_id[service.id])
+            for service in services
+            if service.image.pending
+        ])
+
+    async def _run():
+        try:
+            await asyncio.gather(*[
+                _stack_task(stack_name, containers)
+                for stack_name, containers in sorted(_compose_stacks_containers(snapshot).items())
+            ])
+        finally:
+            memo.log_stats('stream_compose_stacks')
+            await queue.put(None)
+
+    task = asyncio.create_task(_run())
+    try:
+        while (item := await queue.get()) is not None:
+            yield item
+        await task  # re-raise any errors
+
+    finally:
+        task.cancel()
+        memo.cancel()
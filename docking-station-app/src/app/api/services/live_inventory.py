@@ -0,0 +1,264 @@
+import asyncio
+import json
+from logging import getLogger
+
+from ..schemas import DockerStack
+from ..settings import get_app_settings
+from ..utils import Singleton
+from . import inventory
+from .engine import get_engine_client
+from .revision_log import StackRevisionLog
+
+__all__ = [
+    'LiveInventory',
+]
+
+logger = getLogger(__name__)
+app_settings = get_app_settings()
+
+CONTAINER_EVENT_ACTIONS = {'create', 'destroy', 'start', 'die'}
+IMAGE_EVENT_ACTIONS = {'pull', 'tag', 'untag', 'delete'}
+
+
+async def _cli_events(filters: dict[str, list[str]]):
+    filter_cmd = [
+        arg
+        for key, values in filters.items()
+        for value in values
+        for arg in ('--filter', f'{key}={value}')
+    ]
+    process = await asyncio.create_subprocess_exec(
+        'docker', 'events', '--format', '{{json .}}', *filter_cmd,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    try:
+        async for line in process.stdout:
+            if line := line.strip():
+                yield json.loads(line)
+    finally:
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+
+    raise ConnectionError(f'docker events exited with code {process.returncode}')
+
+
+def _events():
+    filters = {'type': ['container', 'image']}
+    if app_settings.server.docker_backend.is_engine_api():
+        return get_engine_client().events(filters=filters)
+    return _cli_events(filters)
+
+
+class LiveInventory(metaclass=Singleton):
+    """
+    In-memory model of the compose stacks, kept up to date by the docker events stream.
+
+    The whole model is built once when the subscriber starts (and again after it reconnects),
+    afterwards every container/image event only rebuilds the `DockerStack` entries it affects.
+    Registry data doesn't produce docker events, so every `cache_control_max_age` all stacks are
+    rebuilt with fresh registry lookups, picking up new upstream releases.
+    """
+
+    def __init__(self, debounce_seconds: float = 0.5):
+        self.debounce_seconds = debounce_seconds
+        self._stacks: dict[str, DockerStack] = {}
+        self._ready = False
+        self._dirty: set[str] = set()
+        self._flush_task: asyncio.Task | None = None
+        self._watch_task: asyncio.Task | None = None
+        self._revalidate_task: asyncio.Task | None = None
+
+    def is_ready(self):
+        return (
+            self._ready
+            and self._watch_task is not None
+            and not self._watch_task.done()
+        )
+
+    def start(self):
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.create_task(self._watch())
+        # without a cache max age there is no interval to revalidate on
+        if app_settings.server.cache_control_max_age_seconds > 0 and (
+            self._revalidate_task is None or self._revalidate_task.done()
+        ):
+            self._revalidate_task = asyncio.create_task(
+                self._revalidate(app_settings.server.cache_control_max_age_seconds)
+            )
+        return self._watch_task
+
+    async def stop(self):
+        self._ready = False
+        for task in (self._watch_task, self._flush_task, self._revalidate_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+
+    def list_stacks(self, include_stopped: bool = False):
+        stacks = sorted(self._stacks.values(), key=lambda x: x.name)
+        if include_stopped:
+            return stacks
+
+        res = []
+        for stack in stacks:
+            services = [
+                service
+                for service in stack.services
+                if service.status in inventory.ACTIVE_STATES
+            ]
+            if services:
+                res.append(
+                    stack.model_copy(update={
+                        **{state: 0 for state in inventory.COMPOSE_STATES},
+                        **{state: getattr(stack, state) for state in inventory.ACTIVE_STATES},
+                        'services': services,
+                    })
+                )
+        return res
+
+    async def refresh(self, no_cache: bool = False):
+        """Rebuild the whole model from a fresh inventory snapshot"""
+
+        snapshot = await inventory.take_snapshot(
+            filters={'label': inventory.COMPOSE_PROJECT_LABEL},
+            include_stopped=True,
+        )
+        stacks = await inventory.build_compose_stacks(
+            snapshot=snapshot,
+            no_cache=no_cache,
+        )
+        self._stacks = {
+            stack.name: stack
+            for stack in stacks
+        }
+        StackRevisionLog().record(self._stacks.values())
+        logger.info('Live inventory refreshed: %d stacks', len(self._stacks))
+        return self.list_stacks(include_stopped=True)
+
+    async def refresh_stacks(self, stack_names: set[str], no_cache: bool = False):
+        """Rebuild only the given stacks, dropping the ones that no longer exist"""
+
+        # stacks often share images, resolve each of them once across all of the rebuilt stacks
+        memo = inventory.ImageLookupMemo()
+
+        async def _task(stack_name: str):
+            snapshot = await inventory.take_snapshot(
+                filters={'label': f'{inventory.COMPOSE_PROJECT_LABEL}={stack_name}'},
+                include_stopped=True,
+            )
+            stacks = await inventory.build_compose_stacks(
+                snapshot=snapshot,
+                no_cache=no_cache,
+                memo=memo,
+            )
+            if stacks:
+                self._stacks[stack_name] = stacks[0]
+            else:
+                self._stacks.pop(stack_name, None)
+
+        await asyncio.gather(*[
+            _task(stack_name)
+            for stack_name in stack_names
+        ])
+        StackRevisionLog().record(
+            [self._stacks[stack_name] for stack_name in stack_names if stack_name in self._stacks],
+            scope=stack_names,
+        )
+        memo.log_stats('Live inventory update')
+        logger.debug('Live inventory updated stacks: %s', ', '.join(sorted(stack_names)))
+
+    def _affected_stacks(self, event: dict) -> set[str]:
+        event_type = event.get('Type')
+        action = event.get('Action', '')
+        actor = event.get('Actor') or {}
+        attributes = actor.get('Attributes') or {}
+
+        match event_type:
+            case 'container' if action in CONTAINER_EVENT_ACTIONS:
+                if stack_name := attributes.get(inventory.COMPOSE_PROJECT_LABEL, None):
+                    return {stack_name}
+
+            case 'image' if action in IMAGE_EVENT_ACTIONS:
+                image_id = actor.get('ID', '')
+                image_name = attributes.get('name', image_id)
+                image_tag = None if image_name.startswith('sha256:') else inventory.clean_image_tag(image_name)
+                return {
+                    stack.name
+                    for stack in self._stacks.values()
+                    for service in stack.services
+                    if service.image.id == image_id or service.image.repo_tag == image_tag
+                }
+
+        return set()
+
+    def _handle_event(self, event: dict):
+        if stack_names := self._affected_stacks(event):
+            self._dirty.update(stack_names)
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        # compose commands emit bursts of events, coalesce them into a single rebuild per stack
+        while self._dirty:
+            await asyncio.sleep(self.debounce_seconds)
+            stack_names, self._dirty = self._dirty, set()
+            try:
+                await self.refresh_stacks(stack_names)
+            except Exception:
+                logger.exception('Error updating live inventory stacks: %s', ', '.join(sorted(stack_names)))
+
+    async def _revalidate(self, interval_seconds: float):
+        while True:
+            await asyncio.sleep(interval_seconds)
+            if not self.is_ready():
+                continue
+            try:
+                await self.refresh_stacks(set(self._stacks), no_cache=True)
+                logger.info('Live inventory revalidated registry data: %d stacks', len(self._stacks))
+            except Exception:
+                logger.exception('Error revalidating live inventory registry data')
+
+    async def _watch(self):
+        backoff = 1
+
+        while True:
+            queue: asyncio.Queue[dict | Exception] = asyncio.Queue()
+
+            async def _subscribe():
+                try:
+                    async for event in _events():
+                        queue.put_nowait(event)
+                except Exception as exc:
+                    queue.put_nowait(exc)
+                else:
+                    queue.put_nowait(ConnectionError('docker events stream closed'))
+
+            subscriber = asyncio.create_task(_subscribe())
+            try:
+                # subscribe before priming the model, so no event is missed in between
+                await self.refresh()
+                self._ready = True
+                backoff = 1
+
+                while True:
+                    event = await queue.get()
+                    if isinstance(event, Exception):
+                        raise event
+                    self._handle_event(event)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                logger.exception('Docker events subscriber failed, reconnecting in %ds', backoff)
+
+            finally:
+                self._ready = False
+                subscriber.cancel()
+
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
@@ -1,13 +1,19 @@
 import asyncio
+import json
+import re
 import subprocess
+from contextlib import asynccontextmanager
 from datetime import timedelta
 from logging import getLogger
 
 from ..schemas import RegctlImageInspect
-from ..settings import cached, get_app_settings
+from ..settings import cache_tag, cached, get_app_settings
+from .registry import ImageReference, get_registry_client
+from .registry_scheduler import get_registry_scheduler
 
 __all__ = [
     'get_image_inspect',
+    'get_image_manifest_digests',
     'get_image_remote_digest',
 ]
 
@@ -15,12 +21,65 @@ app_settings = get_app_settings()
 logger = getLogger(__name__)
 
 
+@asynccontextmanager
+async def _scheduled(repo_tag: str):
+    """Wait for a free lookup slot of the image's registry"""
+
+    registry = ImageReference.parse(repo_tag).registry
+    async with get_registry_scheduler().slot(registry):
+        try:
+            yield
+
+        except Exception as e:
+            # regctl does not expose the registry's response headers, only its error message
+            if app_settings.server.registry_backend.is_regctl() and re.search(r'429|toomanyrequests', str(e), re.I):
+                get_registry_scheduler().observe(registry, 429)
+            raise
+
+
+async def _regctl(*args: str):
+    cmd = ' '.join(['regctl', *[f'"{arg}"' for arg in args]])
+    process = await asyncio.create_subprocess_shell(
+        cmd=cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+
+    if process.returncode != 0:
+        error_message = stderr.decode().strip()
+        raise Exception(f'Error running regctl command: {error_message}')
+
+    return stdout
+
+
+async def _regctl_image_digest(repo_tag: str):
+    logger.debug('regctl image digest request: %s', repo_tag)
+    stdout = await _regctl('image', 'digest', repo_tag)
+    return stdout.decode().strip()
+
+
+async def _regctl_image_inspect(repo_tag: str):
+    logger.debug('regctl image inspect request: %s', repo_tag)
+    stdout = await _regctl('image', 'inspect', repo_tag)
+    return RegctlImageInspect.model_validate_json(stdout)
+
+
+async def _regctl_manifest_digests(repo_digest: str):
+    logger.debug('regctl manifest get request: %s', repo_digest)
+    stdout = await _regctl('manifest', 'get', '--format', 'raw-body', repo_digest)
+    manifest = json.loads(stdout)
+    return [item['digest'] for item in manifest.get('manifests') or []]
+
+
 async def get_image_remote_digest(repo_tag: str, reraise: bool = False, no_cache: bool = False):
     cache_control_max_age_seconds = (timedelta(days=365).total_seconds()
                                      if 'sha256:' in repo_tag
                                      else app_settings.server.cache_control_max_age_seconds)
 
-    @cached(expire=cache_control_max_age_seconds)
+    @cached(expire=cache_control_max_age_seconds,
+            stale_while_revalidate=app_settings.server.cache_max_staleness_seconds,
+            tags=lambda _: [cache_tag('image', repo_tag)])
     async def _get_image_remote_digest(repo_tag: str, no_cache: bool = False):
         nonlocal reraise
 
@@ -30,20 +89,13 @@ async def get_image_remote_digest(repo_tag: str, reraise: bool = False, no_cache
             else:
                 image_name, _tag = repo_tag, ''
 
-            cmd = f'regctl image digest "{repo_tag}"'
-            process = await asyncio.create_subprocess_shell(
-                cmd=cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            logger.debug('regctl image digest request: %s', repo_tag)
-            stdout, stderr = await process.communicate()
+            async with _scheduled(repo_tag):
+                if app_settings.server.registry_backend.is_native():
+                    logger.debug('registry image digest request: %s', repo_tag)
+                    digest = await get_registry_client().get_digest(repo_tag)
+                else:
+                    digest = await _regctl_image_digest(repo_tag)
 
-            if process.returncode != 0:
-                error_message = stderr.decode().strip()
-                raise Exception(f'Error running regctl command: {error_message}')
-
-            digest = stdout.decode().strip()
             res = f'{image_name}@{digest}'
             logger.info('regctl image digest response: %s', res)
             return res
@@ -66,25 +118,19 @@ async def get_image_inspect(repo_tag: str, reraise: bool = False, no_cache: bool
                                      if is_specific_digest
                                      else app_settings.server.cache_control_max_age_seconds)
 
-    @cached(expire=cache_control_max_age_seconds)
+    @cached(expire=cache_control_max_age_seconds,
+            stale_while_revalidate=app_settings.server.cache_max_staleness_seconds,
+            tags=lambda _: [cache_tag('image', repo_tag)])
     async def _get_image_inspect(repo_tag: str, no_cache: bool = False) -> RegctlImageInspect:
         nonlocal reraise
 
         try:
-            cmd = f'regctl image inspect "{repo_tag}"'
-            process = await asyncio.create_subprocess_shell(
-                cmd=cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            logger.debug('regctl image inspect request: %s', repo_tag)
-            stdout, stderr = await process.communicate()
-
-            if process.returncode != 0:
-                error_message = stderr.decode().strip()
-                raise Exception(f'Error running regctl command: {error_message}')
-
-            res = RegctlImageInspect.model_validate_json(stdout)
+            async with _scheduled(repo_tag):
+                if app_settings.server.registry_backend.is_native():
+                    logger.debug('registry image inspect request: %s', repo_tag)
+                    res = await get_registry_client().inspect(repo_tag)
+                else:
+                    res = await _regctl_image_inspect(repo_tag)
             logger.info('regctl image inspect response: %s', res.created)
             return res
 
@@ -98,3 +144,36 @@ async def get_image_inspect(repo_tag: str, reraise: bool = False, no_cache: bool
         repo_tag=repo_tag,
         no_cache=False if is_specific_digest else no_cache,
     )
+
+
+async def get_image_manifest_digests(repo_digest: str, reraise: bool = False, no_cache: bool = False):
+    """
+    Return the digests of the platform manifests listed by a manifest list/index,
+    or an empty list if `repo_digest` is a single platform manifest.
+    """
+
+    @cached(expire=timedelta(days=365).total_seconds())
+    async def _get_image_manifest_digests(repo_digest: str, no_cache: bool = False) -> list[str]:
+        async with _scheduled(repo_digest):
+            if app_settings.server.registry_backend.is_native():
+                logger.debug('registry manifest get request: %s', repo_digest)
+                ref = ImageReference.parse(repo_digest)
+                _, manifest = await get_registry_client().get_manifest(ref)
+                res = [item['digest'] for item in manifest.get('manifests') or []]
+            else:
+                res = await _regctl_manifest_digests(repo_digest)
+        logger.info('regctl manifest get response: %s (%d platform manifests)', repo_digest, len(res))
+        return res
+
+    try:
+        return await _get_image_manifest_digests(
+            repo_digest=repo_digest,
+            no_cache=no_cache,
+        )
+
+    except Exception as e:
+        # raised out of the cached call, so a transient failure isn't cached for a year
+        logger.error('Error running regctl command: %s', e)
+        if reraise:
+            raise Exception(f'Error running regctl command: {e}')
+        return None
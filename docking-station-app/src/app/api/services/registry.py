@@ -0,0 +1,364 @@
+import asyncio
+import base64
+import hashlib
+import json
+import platform
+import re
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from logging import getLogger
+from pathlib import Path
+from typing import Awaitable, Callable
+from weakref import WeakKeyDictionary
+
+import aiohttp
+
+from ..schemas import RegctlImageInspect
+from ..settings import get_app_settings
+from .registry_scheduler import get_registry_scheduler
+
+__all__ = [
+    'ImageReference',
+    'RegistryClient',
+    'RegistryError',
+    'TokenCache',
+    'get_registry_client',
+]
+
+logger = getLogger(__name__)
+app_settings = get_app_settings()
+
+DOCKER_HUB_REGISTRY = 'docker.io'
+DOCKER_HUB_API_HOST = 'registry-1.docker.io'
+DOCKER_HUB_AUTH_KEY = 'https://index.docker.io/v1/'
+DEFAULT_TOKEN_EXPIRES_IN = 60
+
+MANIFEST_LIST_MEDIA_TYPES = (
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+)
+MANIFEST_MEDIA_TYPES = (
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+)
+ACCEPT_HEADER = ', '.join([*MANIFEST_LIST_MEDIA_TYPES, *MANIFEST_MEDIA_TYPES])
+
+_GOARCH = {
+    'x86_64': 'amd64',
+    'amd64': 'amd64',
+    'aarch64': 'arm64',
+    'arm64': 'arm64',
+    'armv7l': 'arm',
+    'armv6l': 'arm',
+    'i386': '386',
+    'i686': '386',
+}
+_auth_param_pattern = re.compile(r'(\w+)="([^"]*)"')
+
+TokenKey = tuple[str, str, str]
+
+
+class RegistryError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f'Registry error ({status}): {message}')
+        self.status = status
+        self.message = message
+
+
+@dataclass(frozen=True)
+class ImageReference:
+    registry: str
+    repository: str
+    tag: str | None = None
+    digest: str | None = None
+
+    @classmethod
+    def parse(cls, value: str):
+        """Parse a docker image reference, applying docker hub's implicit registry and `library/` namespace"""
+
+        name, _, digest = value.partition('@')
+        tag = None
+        if ':' in name.rsplit('/', 1)[-1]:
+            name, tag = name.rsplit(':', 1)
+
+        registry, _, repository = name.partition('/')
+        if not repository or not ('.' in registry or ':' in registry or registry == 'localhost'):
+            registry, repository = DOCKER_HUB_REGISTRY, name
+        if registry in ('index.docker.io', 'registry.hub.docker.com', DOCKER_HUB_API_HOST):
+            registry = DOCKER_HUB_REGISTRY
+        if registry == DOCKER_HUB_REGISTRY and '/' not in repository:
+            repository = f'library/{repository}'
+
+        return cls(
+            registry=registry,
+            repository=repository,
+            tag=tag if tag or digest else 'latest',
+            digest=digest or None,
+        )
+
+    @property
+    def api_host(self):
+        return DOCKER_HUB_API_HOST if self.registry == DOCKER_HUB_REGISTRY else self.registry
+
+    @property
+    def reference(self):
+        return self.digest or self.tag
+
+    @property
+    def familiar_name(self):
+        """The name as docker lists it in an image's `RepoTags`/`RepoDigests`, e.g. `redis` or `user/app`"""
+        if self.registry == DOCKER_HUB_REGISTRY:
+            return self.repository.removeprefix('library/')
+        return f'{self.registry}/{self.repository}'
+
+
+def _local_platform():
+    machine = platform.machine().lower()
+    return 'linux', _GOARCH.get(machine, machine)
+
+
+@lru_cache(maxsize=1)
+def _docker_auths() -> dict[str, str]:
+    config_path = Path.home() / '.docker' / 'config.json'
+    try:
+        return json.loads(config_path.read_text()).get('auths', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _basic_auth(registry: str):
+    """Return the `Basic` credentials stored by `docker login` for the registry, if any"""
+
+    auths = _docker_auths()
+    keys = [DOCKER_HUB_AUTH_KEY, DOCKER_HUB_REGISTRY] if registry == DOCKER_HUB_REGISTRY else [registry, f'https://{registry}']
+    for key in keys:
+        if auth := (auths.get(key) or {}).get('auth', None):
+            return aiohttp.BasicAuth(*base64.b64decode(auth).decode().split(':', 1))
+    return None
+
+
+def _pull_scope(ref: ImageReference):
+    return f'repository:{ref.repository}:pull'
+
+
+@dataclass
+class _Token:
+    value: str
+    expires_at: float
+
+
+class TokenCache:
+    """
+    Registry bearer tokens, keyed by `(registry, repository, scope)`.
+
+    Tokens are dropped a few seconds before they expire,
+    concurrent lookups of a missing token share a single token request.
+    """
+
+    def __init__(self, expiry_margin_seconds: float = 10):
+        self.expiry_margin_seconds = expiry_margin_seconds
+        self.hits = 0
+        self.misses = 0
+        self._tokens: dict[TokenKey, _Token] = {}
+        self._pending: dict[TokenKey, asyncio.Future] = {}
+
+    def get(self, key: TokenKey):
+        if token := self._tokens.get(key, None):
+            if token.expires_at > time.monotonic():
+                self.hits += 1
+                return token.value
+            self._tokens.pop(key, None)
+        return None
+
+    def set(self, key: TokenKey, value: str, expires_in: float):
+        self._tokens[key] = _Token(
+            value=value,
+            expires_at=time.monotonic() + max(expires_in - self.expiry_margin_seconds, 0),
+        )
+
+    def invalidate(self, key: TokenKey):
+        self._tokens.pop(key, None)
+
+    async def get_or_fetch(self, key: TokenKey, fetch: Callable[[], Awaitable[tuple[str, float]]]):
+        if token := self.get(key):
+            return token
+        if key in self._pending:
+            self.hits += 1
+            return await asyncio.shield(self._pending[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value, expires_in = await fetch()
+            self.set(key, value, expires_in)
+            future.set_result(value)
+            return value
+
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()  # mark as retrieved, waiters (if any) get it re-raised
+            raise
+
+        finally:
+            self._pending.pop(key, None)
+
+
+class RegistryClient:
+    """
+    In-process async OCI distribution client, used in place of the `regctl` CLI.
+
+    Every registry gets its own pooled keep-alive connector (one pool per event loop).
+    """
+
+    def __init__(self, max_connections: int = None, insecure_registries: list[str] = None):
+        self.max_connections = max_connections or app_settings.server.registry_max_connections
+        self.insecure_registries = set(
+            app_settings.server.insecure_registries
+            if insecure_registries is None
+            else insecure_registries
+        )
+        self.tokens = TokenCache()
+        self._sessions: WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, aiohttp.ClientSession]] = WeakKeyDictionary()
+
+    def _get_session(self, ref: ImageReference):
+        sessions = self._sessions.setdefault(asyncio.get_running_loop(), {})
+        session = sessions.get(ref.api_host, None)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections,
+                    keepalive_timeout=30,
+                ),
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+            sessions[ref.api_host] = session
+        return session
+
+    async def close(self):
+        for session in self._sessions.pop(asyncio.get_running_loop(), {}).values():
+            await session.close()
+
+    def _url(self, ref: ImageReference, path: str):
+        scheme = 'http' if ref.registry in self.insecure_registries else 'https'
+        return f'{scheme}://{ref.api_host}/v2/{ref.repository}/{path}'
+
+    async def _fetch_token(self, ref: ImageReference, realm: str, params: dict[str, str]):
+        async with self._get_session(ref).get(realm, params=params, auth=_basic_auth(ref.registry)) as response:
+            if response.status >= 400:
+                raise RegistryError(response.status, f'token request failed: {await response.text()}')
+            data = await response.json(content_type=None)
+            logger.debug('Registry token fetched: %s %s', ref.registry, params.get('scope'))
+            return (
+                data.get('token') or data.get('access_token'),
+                data.get('expires_in') or DEFAULT_TOKEN_EXPIRES_IN,
+            )
+
+    async def _authorization(self, ref: ImageReference, challenge: str):
+        scheme, _, _ = challenge.partition(' ')
+        match scheme.lower():
+            case 'bearer':
+                params = dict(_auth_param_pattern.findall(challenge))
+                realm = params.pop('realm')
+                params.setdefault('scope', _pull_scope(ref))
+                token = await self.tokens.get_or_fetch(
+                    (ref.registry, ref.repository, params['scope']),
+                    lambda: self._fetch_token(ref, realm, params),
+                )
+                return f'Bearer {token}'
+            case 'basic' if (auth := _basic_auth(ref.registry)):
+                return auth.encode()
+        raise RegistryError(401, f'unsupported auth challenge: {challenge!r}')
+
+    async def request(self,
+                      method: str,
+                      ref: ImageReference,
+                      path: str,
+                      headers: dict[str, str] = None):
+        """Send a request to the registry, answering its auth challenge if needed. Returns `(response, body)`"""
+
+        session = self._get_session(ref)
+        url = self._url(ref, path)
+        headers = dict(headers or {})
+        token_key = (ref.registry, ref.repository, _pull_scope(ref))
+        if token := self.tokens.get(token_key):
+            headers['Authorization'] = f'Bearer {token}'
+
+        for attempt in range(2):
+            async with session.request(method, url, headers=headers) as response:
+                body = await response.read()
+                logger.debug('Registry request: %s %s -> %d', method, url, response.status)
+                get_registry_scheduler().observe(ref.registry, response.status, response.headers)
+
+                if response.status == 401 and attempt == 0:
+                    if challenge := response.headers.get('WWW-Authenticate', None):
+                        # the cached token (if any) was rejected, e.g. revoked before its expiry
+                        self.tokens.invalidate(token_key)
+                        headers['Authorization'] = await self._authorization(ref, challenge)
+                        continue
+
+                if response.status >= 400:
+                    raise RegistryError(response.status, body.decode(errors='replace') or response.reason)
+                return response, body
+
+        raise RegistryError(401, f'unauthorized: {ref.registry}/{ref.repository}')
+
+    async def get_manifest(self, ref: ImageReference, reference: str = None):
+        response, body = await self.request('GET', ref, f'manifests/{reference or ref.reference}',
+                                            headers={'Accept': ACCEPT_HEADER})
+        manifest = json.loads(body)
+        media_type = manifest.get('mediaType') or response.content_type
+        return media_type, manifest
+
+    async def get_digest(self, repo_tag: str):
+        """Resolve `repo_tag` to its manifest digest using a `HEAD` request"""
+
+        ref = ImageReference.parse(repo_tag)
+        if ref.digest:
+            return ref.digest
+
+        response, _ = await self.request('HEAD', ref, f'manifests/{ref.reference}',
+                                         headers={'Accept': ACCEPT_HEADER})
+        if digest := response.headers.get('Docker-Content-Digest', None):
+            return digest
+
+        # some registries omit the digest header on HEAD requests
+        _, body = await self.request('GET', ref, f'manifests/{ref.reference}',
+                                     headers={'Accept': ACCEPT_HEADER})
+        return f'sha256:{hashlib.sha256(body).hexdigest()}'
+
+    async def get_platform_manifest(self, ref: ImageReference):
+        """Fetch the image manifest, resolving manifest lists/indexes to the local platform's manifest"""
+
+        media_type, manifest = await self.get_manifest(ref)
+        if media_type not in MANIFEST_LIST_MEDIA_TYPES and 'manifests' not in manifest:
+            return manifest
+
+        # no fallback, other entries are foreign architectures or attestations (`unknown/unknown`)
+        os_name, architecture = _local_platform()
+        descriptor = next(
+            (item
+             for item in manifest.get('manifests') or []
+             if (item.get('platform') or {}).get('os') == os_name
+             and (item.get('platform') or {}).get('architecture') == architecture),
+            None,
+        )
+        if descriptor is None:
+            raise RegistryError(404, f'no {os_name}/{architecture} manifest for {ref.registry}/{ref.repository}')
+
+        _, manifest = await self.get_manifest(ref, descriptor['digest'])
+        return manifest
+
+    async def inspect(self, repo_tag: str):
+        """Fetch the image's config blob, the same document `regctl image inspect` prints"""
+
+        ref = ImageReference.parse(repo_tag)
+        manifest = await self.get_platform_manifest(ref)
+        _, body = await self.request('GET', ref, f'blobs/{manifest["config"]["digest"]}')
+        return RegctlImageInspect.model_validate_json(body)
+
+
+@lru_cache(maxsize=1)
+def get_registry_client():
+    return RegistryClient()
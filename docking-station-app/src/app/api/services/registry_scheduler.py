@@ -0,0 +1,164 @@
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+from logging import getLogger
+from typing import Mapping
+
+from ..schemas import RegistryRateLimit
+from ..settings import get_app_settings
+
+__all__ = [
+    'RegistryBudget',
+    'RegistryScheduler',
+    'get_registry_scheduler',
+]
+
+logger = getLogger(__name__)
+app_settings = get_app_settings()
+
+MIN_BACKOFF_SECONDS = 5
+MAX_BACKOFF_SECONDS = 300
+_ratelimit_header_pattern = re.compile(r'^\s*(\d+)(?:\s*;\s*w=(\d+))?')
+
+
+def _parse_ratelimit_header(value: str | None):
+    """Parse `ratelimit-*` headers such as `100;w=21600`, returns `(value, window_seconds)`"""
+    if value and (match := _ratelimit_header_pattern.match(value)):
+        count, window = match.groups()
+        return int(count), int(window) if window else None
+    return None, None
+
+
+@dataclass
+class RegistryBudget:
+    registry: str
+    max_concurrent: int
+    rate: float
+    burst: int
+    limit: int | None = None
+    remaining: int | None = None
+    window_seconds: int | None = None
+    in_flight: int = 0
+    paused_until: float = 0
+    tokens: float = field(init=False)
+    _backoff: float = field(default=0, init=False)
+    _updated_at: float = field(default_factory=time.monotonic, init=False)
+    _semaphore: asyncio.Semaphore = field(init=False)
+
+    def __post_init__(self):
+        self.tokens = self.burst
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def _take_token(self):
+        while True:
+            if (delay := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._semaphore:
+            await self._take_token()
+            self.in_flight += 1
+            try:
+                yield self
+            finally:
+                self.in_flight -= 1
+
+    def _pause(self, seconds: float, reason: str):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        logger.warning('Pausing %s registry lookups for %.0fs: %s', self.registry, seconds, reason)
+
+    def observe(self, status: int, headers: Mapping[str, str] = None):
+        """Adapt to a registry response, using its status and `ratelimit-*` headers"""
+
+        headers = headers or {}
+        limit, window = _parse_ratelimit_header(headers.get('ratelimit-limit', headers.get('x-ratelimit-limit')))
+        remaining, _ = _parse_ratelimit_header(headers.get('ratelimit-remaining', headers.get('x-ratelimit-remaining')))
+        if limit is not None:
+            self.limit = limit
+            self.window_seconds = window or self.window_seconds
+        if remaining is not None:
+            self.remaining = remaining
+
+        if status == 429:
+            retry_after, _ = _parse_ratelimit_header(headers.get('retry-after'))
+            self._backoff = min(max(self._backoff * 2, MIN_BACKOFF_SECONDS), MAX_BACKOFF_SECONDS)
+            self._pause(retry_after or self._backoff, 'too many requests')
+            return
+
+        self._backoff = 0
+        if self.remaining is not None and self.remaining <= app_settings.server.registry_ratelimit_reserve:
+            # spread what is left of the budget over the rest of the window
+            window = self.window_seconds or MAX_BACKOFF_SECONDS
+            self._pause(min(window / max(self.remaining, 1), MAX_BACKOFF_SECONDS),
+                        f'{self.remaining} requests remaining')
+
+    def to_schema(self):
+        self._refill()
+        return RegistryRateLimit(
+            registry=self.registry,
+            limit=self.limit,
+            remaining=self.remaining,
+            window_seconds=self.window_seconds,
+            in_flight=self.in_flight,
+            tokens=self.tokens,
+            paused_for_seconds=max(self.paused_until - time.monotonic(), 0),
+        )
+
+
+class RegistryScheduler:
+    """
+    Schedules registry lookups per registry, using a concurrency limit and a token bucket,
+    and backs off when the registry reports its rate limit budget is (almost) exhausted.
+    """
+
+    def __init__(self,
+                 max_concurrent: int = None,
+                 rate: float = None,
+                 burst: int = None):
+        self.max_concurrent = max_concurrent or app_settings.server.registry_max_concurrent_lookups
+        self.rate = rate or app_settings.server.registry_lookups_per_second
+        self.burst = burst or app_settings.server.registry_lookups_burst
+        self._budgets: dict[str, RegistryBudget] = {}
+
+    def budget(self, registry: str):
+        if registry not in self._budgets:
+            self._budgets[registry] = RegistryBudget(
+                registry=registry,
+                max_concurrent=self.max_concurrent,
+                rate=self.rate,
+                burst=self.burst,
+            )
+        return self._budgets[registry]
+
+    def slot(self, registry: str):
+        return self.budget(registry).slot()
+
+    def observe(self, registry: str, status: int, headers: Mapping[str, str] = None):
+        self.budget(registry).observe(status, headers)
+
+    def list_budgets(self):
+        return [
+            self._budgets[registry].to_schema()
+            for registry in sorted(self._budgets)
+        ]
+
+
+@lru_cache(maxsize=1)
+def get_registry_scheduler():
+    return RegistryScheduler()
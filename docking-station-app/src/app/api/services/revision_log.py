@@ -0,0 +1,190 @@
+import asyncio
+import time
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock
+from typing import Iterable
+
+from ..schemas import DockerContainer, DockerStack, DockerStackChanges
+from ..utils import Singleton
+
+__all__ = [
+    'StackRevisionLog',
+]
+
+logger = getLogger(__name__)
+
+ServiceKey = tuple[str, str]
+
+
+def _fingerprint(service: DockerContainer):
+    """the fields a change feed client cares about"""
+    image = service.image
+    return (
+        service.status,
+        image.repo_local_digest if image else None,
+        image.version if image else None,
+        image.latest_version if image else None,
+        service.has_updates if image else False,
+    )
+
+
+class StackRevisionLog(metaclass=Singleton):
+    """
+    Revision log of the compose services, backing the `/api/stacks/changes` feed.
+
+    Every recorded inventory is diffed against the previous one, services whose
+    status, digest, version or `has_updates` changed are stamped with a new revision.
+    Cursors are `<epoch>.<revision>`, so cursors from a previous server run are detected.
+    """
+
+    def __init__(self, max_tombstones: int = 1000):
+        self.max_tombstones = max_tombstones
+        self.epoch = f'{int(time.time()):x}'
+        self.revision = 0
+        self.updated_at: float | None = None
+        self._lock = Lock()
+        self._services: dict[ServiceKey, DockerContainer] = {}
+        self._fingerprints: dict[ServiceKey, tuple] = {}
+        # both ordered by revision, oldest first
+        self._revisions: OrderedDict[ServiceKey, int] = OrderedDict()
+        self._tombstones: OrderedDict[ServiceKey, int] = OrderedDict()
+        # changes up to (and including) this revision are no longer known
+        self._horizon = 0
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = set()
+
+    @property
+    def cursor(self):
+        return f'{self.epoch}.{self.revision}'
+
+    def _parse_cursor(self, cursor: str | None):
+        """returns the cursor's revision, or `None` when the client has to start over"""
+        if not cursor:
+            return None
+        epoch, _, revision = cursor.partition('.')
+        if epoch != self.epoch or not revision.isdigit():
+            return None
+        revision = int(revision)
+        if revision < self._horizon or revision > self.revision:
+            return None
+        return revision
+
+    def record(self, stacks: Iterable[DockerStack], scope: Iterable[str] | None = None):
+        """
+        Record an inventory listing.
+
+        `scope` names the stacks the listing fully describes, services of these stacks missing from it are removed.
+        Defaults to `None`, meaning the listing is the whole inventory.
+        Returns the number of changed services.
+        """
+
+        scope = None if scope is None else set(scope)
+        with self._lock:
+            seen: set[ServiceKey] = set()
+            changed: list[ServiceKey] = []
+
+            for stack in stacks:
+                for service in stack.services:
+                    if service.image is not None and service.image.pending:
+                        # not fully resolved yet, wait for the complete listing
+                        seen.add((stack.name, service.service_name))
+                        continue
+
+                    key = (stack.name, service.service_name)
+                    seen.add(key)
+                    fingerprint = _fingerprint(service)
+                    if self._fingerprints.get(key, None) != fingerprint:
+                        self._fingerprints[key] = fingerprint
+                        changed.append(key)
+                    self._services[key] = service
+
+            removed = [
+                key
+                for key in self._services
+                if key not in seen
+                and (scope is None or key[0] in scope)
+            ]
+
+            self.updated_at = time.monotonic()
+            if not changed and not removed:
+                return 0
+
+            self.revision += 1
+            for key in changed:
+                self._tombstones.pop(key, None)
+                self._revisions[key] = self.revision
+                self._revisions.move_to_end(key)
+
+            for key in removed:
+                self._services.pop(key, None)
+                self._fingerprints.pop(key, None)
+                self._revisions.pop(key, None)
+                self._tombstones[key] = self.revision
+
+            while len(self._tombstones) > self.max_tombstones:
+                _, revision = self._tombstones.popitem(last=False)
+                self._horizon = max(self._horizon, revision)
+
+            waiters, self._waiters = self._waiters, set()
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+        logger.debug('Stack revision %d: %d changed, %d removed services',
+                     self.revision, len(changed), len(removed))
+        return len(changed) + len(removed)
+
+    def changes(self, since: str | None = None):
+        """Services changed after the `since` cursor, or every known service if the cursor can't be served"""
+
+        with self._lock:
+            revision = self._parse_cursor(since)
+            if revision is None:
+                return DockerStackChanges(
+                    cursor=self.cursor,
+                    reset=True,
+                    services=list(self._services.values()),
+                )
+
+            services = []
+            for key, key_revision in reversed(self._revisions.items()):
+                if key_revision <= revision:
+                    break
+                services.append(self._services[key])
+
+            removed = []
+            for key, key_revision in reversed(self._tombstones.items()):
+                if key_revision <= revision:
+                    break
+                removed.append('/'.join(key))
+
+            return DockerStackChanges(
+                cursor=self.cursor,
+                services=services[::-1],
+                removed=removed[::-1],
+            )
+
+    async def wait(self, cursor: str, timeout: float | None = None):
+        """Wait until there are changes past `cursor`, returns `False` on timeout"""
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if cursor != self.cursor:
+                return True
+            waiter = (loop, future)
+            self._waiters.add(waiter)
+
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
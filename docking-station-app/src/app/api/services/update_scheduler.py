@@ -0,0 +1,130 @@
+from dataclasses import dataclass, field
+from itertools import count
+from logging import getLogger
+from queue import PriorityQueue
+from threading import Lock, Thread
+from typing import Callable
+
+from ..schemas import MessageDict, UpdatePriorityEnum
+from ..settings import get_app_settings
+from ..task_store import TaskStoreItem
+from ..utils import Singleton
+
+__all__ = [
+    'UpdateScheduler',
+]
+
+logger = getLogger(__name__)
+app_settings = get_app_settings()
+
+
+@dataclass(order=True)
+class _UpdateJob:
+    rank: int
+    seq: int
+    name: str = field(compare=False)
+    task: TaskStoreItem = field(compare=False)
+    run: Callable[[TaskStoreItem], None] = field(compare=False)
+
+
+class UpdateScheduler(metaclass=Singleton):
+    """
+    Runs update jobs on a bounded pool of worker threads (`update_max_workers`).
+
+    Jobs wait in a priority queue, updates requested from the UI (`high`) are picked before the auto-updater's (`low`),
+    jobs of the same priority run in submission order.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max(max_workers or app_settings.server.update_max_workers, 1)
+        self._queue: PriorityQueue[_UpdateJob] = PriorityQueue()
+        self._seq = count()
+        self._lock = Lock()
+        self._workers: list[Thread] = []
+        self._running: set[str] = set()
+
+    def submit(self,
+               name: str,
+               task: TaskStoreItem,
+               run: Callable[[TaskStoreItem], None],
+               priority: UpdatePriorityEnum = UpdatePriorityEnum.HIGH):
+        """Queue `run(task)`, `task` is marked as running/finished around the call"""
+
+        task.priority = priority
+        job = _UpdateJob(
+            rank=priority.rank,
+            seq=next(self._seq),
+            name=name,
+            task=task,
+            run=run,
+        )
+        with self._queue.mutex:
+            position = 1 + sum(item < job for item in self._queue.queue)
+        # before queueing, so the message can't follow the worker's own messages
+        task.append_message(
+            MessageDict(
+                stage='Queued',
+                message=f'Position {position} in the update queue',
+            )
+        )
+        self._queue.put(job)
+        logger.info('Update queued: %s (%s priority)', name, priority)
+        self._ensure_workers()
+        return task
+
+    def position(self, task: TaskStoreItem):
+        """1-based position of the task in the queue, `None` once it was picked up by a worker"""
+
+        with self._queue.mutex:
+            jobs = list(self._queue.queue)
+        job = next((item for item in jobs if item.task is task), None)
+        if job is None:
+            return None
+        return 1 + sum(item < job for item in jobs)
+
+    def stats(self):
+        return {
+            'workers': self.max_workers,
+            'queued': self._queue.qsize(),
+            'running': len(self._running),
+        }
+
+    def _ensure_workers(self):
+        with self._lock:
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            while len(self._workers) < self.max_workers:
+                worker = Thread(
+                    target=self._work,
+                    name=f'update-worker-{len(self._workers)}',
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            self._running.add(job.name)
+            job.task.set_running()
+            logger.info('Update started: %s', job.name)
+            try:
+                job.run(job.task)
+
+            except Exception as exc:
+                logger.exception('Update failed: %s', job.name)
+                # readers get the error along with the rest of the output, it is also kept for `/status`
+                job.task.append_message(
+                    MessageDict(
+                        stage='Error',
+                        message=str(exc),
+                    )
+                )
+                job.task.set_done(error=exc)
+
+            else:
+                logger.info('Update finished: %s', job.name)
+                job.task.set_done()
+
+            finally:
+                self._running.discard(job.name)
+                self._queue.task_done()
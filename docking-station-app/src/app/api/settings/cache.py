@@ -1,9 +1,17 @@
+import asyncio
+import hashlib
 import inspect
 import logging
+import sqlite3
 import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from functools import wraps
-from typing import Any, Awaitable, Callable, Optional, Type, TypeVar
+from typing import Any, Awaitable, Callable, Iterable, Optional, Type, TypeVar
 
 from fastapi import Request, Response
 from fastapi.concurrency import run_in_threadpool
@@ -14,6 +22,8 @@ from pydantic import BaseModel
 from sqlmodel import Session, col, delete
 
 from ..models import FastAPICacheItem, engine
+from ..models import db_path as models_db_path
+from ..utils import Singleton
 
 if sys.version_info >= (3, 10):
     from typing import ParamSpec
@@ -25,11 +35,44 @@ P = ParamSpec('P')
 R = TypeVar('R')
 
 __all__ = [
+    'AsyncSQLiteBackend',
+    'cache_counters',
     'cache_key_builder',
+    'cache_tag',
+    'content_etag',
+    'etag_response',
+    'CacheCounters',
     'cached',
+    'CacheSweeper',
+    'CacheSweeperStats',
+    'CacheSweepResult',
     'SQLiteBackend',
+    'TieredBackend',
 ]
 
+_MISSING = object()
+_revalidating: dict[str, asyncio.Task] = {}
+_in_flight: dict[str, asyncio.Future] = {}
+
+
+@dataclass
+class CacheCounters:
+    hits: int = 0
+    stale_hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+
+    @property
+    def in_flight(self):
+        return len(_in_flight)
+
+    @property
+    def revalidating(self):
+        return len(_revalidating)
+
+
+cache_counters = CacheCounters()
+
 
 def cache_key_builder(func: Callable,
                       prefix: str = '',
@@ -53,11 +96,61 @@ def cache_key_builder(func: Callable,
     return f'{prefix}{key}'
 
 
+def content_etag(content: str | bytes):
+    """
+    Stable ETag of a response body.
+    Weak, since the same content may be served gzip-encoded.
+    """
+    if isinstance(content, str):
+        content = content.encode()
+    return f'W/"{hashlib.sha256(content).hexdigest()}"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag.removeprefix('W/')
+    return any(
+        item.strip().removeprefix('W/') == opaque_tag
+        for item in if_none_match.split(',')
+    )
+
+
+def etag_response(request: Request,
+                  content: str | bytes,
+                  headers: dict[str, str] = None,
+                  media_type: str = 'application/json'):
+    """Respond with `content` and its ETag, or with `304 Not Modified` if the client already has it"""
+    headers = {**(headers or {}), 'ETag': content_etag(content)}
+    if _etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+def cache_tag(kind: str, *parts: str):
+    """build a cache tag, e.g. `cache_tag('service', 'my-stack', 'web') == 'service:my-stack/web'`"""
+    return f'{kind}:{"/".join(parts)}'
+
+
 def cached(expire: Optional[int] = None,
            coder: Optional[Type[Coder]] = None,
            key_builder: Optional[Callable[..., Any]] = None,
            namespace: Optional[str] = '',
-           return_type: Optional[type[BaseModel]] = None) -> Callable[[Callable[P, Awaitable[R]]], Callable[P, Awaitable[R]]]:
+           return_type: Optional[type[BaseModel]] = None,
+           bypass: Optional[Callable[[], bool]] = None,
+           stale_while_revalidate: Optional[int] = None,
+           tags: Optional[Callable[[R], Iterable[str]]] = None) -> Callable[[Callable[P, Awaitable[R]]], Callable[P, Awaitable[R]]]:
+    """
+    `bypass` - when it returns `True`, the call goes straight to the wrapped function without touching the cache
+    (e.g. when a fresher in-memory source is available).
+
+    `stale_while_revalidate` - seconds an expired item is still served for,
+    while a single background call refreshes it. The `X-Cache-Status` response header is set to `fresh`, `stale` or `miss`.
+
+    `tags` - returns the tags of a result (see `cache_tag`), so it can be invalidated using `backend.clear(tag=...)`.
+    """
 
     def wrapper(func: Callable[P, Awaitable[R]]) -> Callable[P, Awaitable[R]]:
         signature = inspect.signature(func)
@@ -139,9 +232,30 @@ def cached(expire: Optional[int] = None,
                     # see above why we have to await even although caller also awaits.
                     return await run_in_threadpool(func, *args, **kwargs)
 
+            if bypass is not None and bypass():
+                ret = await ensure_async_func(*args, **kwargs)
+                if (request := kwargs.get('request', None)) and request.method == 'GET':
+                    return etag_response(request, (coder or FastAPICache.get_coder()).encode(ret))
+                return ret
+
             coder = coder or FastAPICache.get_coder()
             expire = expire or FastAPICache.get_expire()
             key_builder = key_builder or FastAPICache.get_key_builder()
+            max_stale = int(stale_while_revalidate or 0)
+            store_expire = expire + max_stale
+
+            async def store(ret: R, encoded_ret: str):
+                if tags is not None:
+                    await backend.set(cache_key, encoded_ret, store_expire, tags=set(tags(ret)))
+                else:
+                    await backend.set(cache_key, encoded_ret, store_expire)
+
+            def decode(data: str):
+                value = coder.decode(data)
+                if return_type and issubclass(return_type, BaseModel):
+                    return return_type.model_validate(value)
+                return value
+
             copy_kwargs = kwargs.copy()
             no_cache: bool = copy_kwargs.pop("no_cache", False)
             request: Optional[Request] = copy_kwargs.pop("request", None)
@@ -184,62 +298,115 @@ def cached(expire: Optional[int] = None,
                     or not FastAPICache.get_enable()
             ):
                 ret = await ensure_async_func(*args, **kwargs)
+                encoded_ret = coder.encode(ret)
                 if not no_store:
-                    await backend.set(cache_key, coder.encode(ret), expire)
+                    await store(ret, encoded_ret)
+                if request is not None and request.method == 'GET':
+                    return etag_response(request, encoded_ret, {'X-Cache-Status': 'miss'})
                 return ret
 
+            value = _MISSING
             try:
-                ttl, ret = await backend.get_with_ttl(cache_key)
+                if isinstance(backend, TieredBackend) and not request:
+                    # hot keys are served from memory, along with the value decoded by a previous hit
+                    # (requests are answered with the stored body as is, they do not need the decoded value)
+                    ttl, ret, value = await backend.get_decoded_with_ttl(cache_key, decode)
+                else:
+                    ttl, ret = await backend.get_with_ttl(cache_key)
             except Exception:
                 logger.warning(
                     f"Error retrieving cache key '{cache_key}' from backend:", exc_info=True
                 )
                 ttl, ret = 0, None
-            if not request:
-                if ret is not None:
-                    ret = coder.decode(ret)
-                    if return_type and issubclass(return_type, BaseModel):
-                        return return_type.model_validate(ret)
-                    return ret
 
-                ret = await ensure_async_func(*args, **kwargs)
+            def decode_ret():
+                return decode(ret) if value is _MISSING else value
+
+            async def revalidate():
                 try:
-                    await backend.set(cache_key, coder.encode(ret), expire)
+                    ret = await ensure_async_func(*args, **kwargs)
+                    await store(ret, coder.encode(ret))
+                    logger.debug('Revalidated stale cache key: %s', cache_key)
                 except Exception:
-                    logger.warning(
-                        f"Error setting cache key '{cache_key}' in backend:", exc_info=True
-                    )
+                    logger.warning(f"Error revalidating cache key '{cache_key}':", exc_info=True)
+                finally:
+                    _revalidating.pop(cache_key, None)
+
+            # items are stored for `expire + max_stale` seconds, they are stale for the last `max_stale` of them
+            is_stale = max_stale > 0 and ret is not None and ttl <= max_stale
+            if is_stale and cache_key not in _revalidating:
+                _revalidating[cache_key] = asyncio.create_task(revalidate())
+
+            async def compute() -> tuple[R, str]:
+                """run the wrapped function on a miss, concurrent misses of the same key await a single call"""
+                future = _in_flight.get(cache_key, None)
+                if future is not None and future.get_loop() is asyncio.get_running_loop():
+                    cache_counters.coalesced += 1
+                    return await asyncio.shield(future)
+
+                cache_counters.misses += 1
+                future = asyncio.get_running_loop().create_future()
+                _in_flight[cache_key] = future
+                try:
+                    ret = await ensure_async_func(*args, **kwargs)
+                    encoded_ret = coder.encode(ret)
+                    try:
+                        await store(ret, encoded_ret)
+                    except Exception:
+                        logger.warning(
+                            f"Error setting cache key '{cache_key}' in backend:", exc_info=True
+                        )
+                    future.set_result((ret, encoded_ret))
+                    return ret, encoded_ret
+
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+
+                except Exception as exc:
+                    future.set_exception(exc)
+                    future.exception()  # mark as retrieved, waiters (if any) get it re-raised
+                    raise
+
+                finally:
+                    if _in_flight.get(cache_key, None) is future:
+                        _in_flight.pop(cache_key)
+
+            if ret is not None:
+                if is_stale:
+                    cache_counters.stale_hits += 1
+                else:
+                    cache_counters.hits += 1
+
+            if not request:
+                if ret is not None:
+                    return decode_ret()
+
+                ret, _ = await compute()
                 return ret
 
             if request.method != "GET":
                 return await ensure_async_func(request, *args, **kwargs)
 
-            if_none_match = request.headers.get("if-none-match")
-            if ret is not None:
-                if response:
-                    # response.headers["Cache-Control"] = f"max-age={ttl}"
-                    etag = f"W/{hash(ret)}"
-                    if if_none_match == etag:
-                        response.status_code = 304
-                        return response
-                    response.headers["ETag"] = etag
-                ret = coder.decode(ret)
-                if return_type and issubclass(return_type, BaseModel):
-                    return return_type.model_validate(ret)
-                return ret
-
-            ret = await ensure_async_func(*args, **kwargs)
-            encoded_ret = coder.encode(ret)
+            def encoded_response(encoded_ret: str, cache_status: str):
+                """pass the stored body through as is, skipping the decode/validate/serialize round-trip"""
+                # response.headers["Cache-Control"] = f"max-age={ttl}"
+                return etag_response(
+                    request,
+                    encoded_ret,
+                    headers={
+                        **{key: value
+                           for key, value in (response.headers.items() if response else [])
+                           if key != 'content-length'},
+                        "X-Cache-Status": cache_status,
+                    },
+                )
 
-            try:
-                await backend.set(cache_key, encoded_ret, expire)
-            except Exception:
-                logger.warning(f"Error setting cache key '{cache_key}' in backend:", exc_info=True)
+            if ret is not None:
+                return encoded_response(ret, 'stale' if is_stale else 'fresh')
 
-            # response.headers["Cache-Control"] = f"max-age={expire}"
-            etag = f"W/{hash(encoded_ret)}"
-            response.headers["ETag"] = etag
-            return ret
+            _, encoded_ret = await compute()
+            return encoded_response(encoded_ret, 'miss')
 
         return inner
 
@@ -316,3 +483,459 @@ class SQLiteBackend(Backend):
                 count = result.rowcount
 
         return count
+
+
+@dataclass
+class CacheSweepResult:
+    purged: int
+    evicted: int
+    rows: int
+    size_bytes: int
+
+
+class AsyncSQLiteBackend(Backend):
+    """
+    SQLite cache backend that never blocks the event loop.
+
+    - a single long-lived connection in WAL mode, owned by a dedicated worker thread
+    - constant SQL statements, so sqlite3's statement cache keeps them prepared
+    - `set` is write-behind: writes are buffered and flushed in batches, one transaction per batch
+    """
+
+    SELECT_SQL = 'SELECT data, ttl_ts FROM fast_api_cache WHERE key = ?'
+    DELETE_SQL = 'DELETE FROM fast_api_cache WHERE key = ?'
+    DELETE_EXPIRED_SQL = 'DELETE FROM fast_api_cache WHERE key = ? AND ttl_ts < ?'
+    DELETE_NAMESPACE_SQL = 'DELETE FROM fast_api_cache WHERE substr(key, 1, ?) = ?'
+    UPSERT_SQL = (
+        'INSERT INTO fast_api_cache (key, data, ttl_ts, accessed_ts, created_at, updated_at) '
+        'VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP) '
+        'ON CONFLICT (key) DO UPDATE SET '
+        'data = excluded.data, ttl_ts = excluded.ttl_ts, accessed_ts = excluded.accessed_ts, '
+        'updated_at = CURRENT_TIMESTAMP'
+    )
+    TOUCH_SQL = 'UPDATE fast_api_cache SET accessed_ts = ? WHERE key = ?'
+    DELETE_TAG_SQL = 'DELETE FROM fast_api_cache WHERE key IN (SELECT key FROM fast_api_cache_tags WHERE tag = ?)'
+    SELECT_TAG_KEYS_SQL = 'SELECT key FROM fast_api_cache_tags WHERE tag = ?'
+    DELETE_KEY_TAGS_SQL = 'DELETE FROM fast_api_cache_tags WHERE key = ?'
+    INSERT_KEY_TAG_SQL = 'INSERT OR IGNORE INTO fast_api_cache_tags (key, tag) VALUES (?, ?)'
+    PURGE_EXPIRED_SQL = (
+        'DELETE FROM fast_api_cache WHERE rowid IN '
+        '(SELECT rowid FROM fast_api_cache WHERE ttl_ts < ? LIMIT ?)'
+    )
+    EVICT_LRU_SQL = (
+        'DELETE FROM fast_api_cache WHERE rowid IN '
+        '(SELECT rowid FROM fast_api_cache ORDER BY accessed_ts LIMIT ?)'
+    )
+
+    def __init__(self, db_path: str = None, flush_interval_seconds: float = 0.05):
+        self.db_path = db_path or models_db_path
+        self.flush_interval_seconds = flush_interval_seconds
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-cache')
+        self._connection: sqlite3.Connection | None = None
+        self._pending: dict[str, tuple[str, int, frozenset[str]]] = {}
+        self._touched: dict[str, int] = {}
+        self._pending_lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._flush_task: asyncio.Task | None = None
+
+    @staticmethod
+    def _now():
+        return int(time.time())
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=32)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._migrate(self._connection)
+        return self._connection
+
+    @staticmethod
+    def _migrate(connection: sqlite3.Connection):
+        """add the `accessed_ts` column (LRU eviction) and the tags side table to caches created by older versions"""
+        columns = {row[1] for row in connection.execute('PRAGMA table_info(fast_api_cache)')}
+        with connection:
+            if 'accessed_ts' not in columns:
+                connection.execute('ALTER TABLE fast_api_cache ADD COLUMN accessed_ts INTEGER NOT NULL DEFAULT 0')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_fast_api_cache_accessed_ts ON fast_api_cache (accessed_ts)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_fast_api_cache_ttl_ts ON fast_api_cache (ttl_ts)')
+            connection.execute('CREATE TABLE IF NOT EXISTS fast_api_cache_tags '
+                               '(key VARCHAR NOT NULL, tag VARCHAR NOT NULL, PRIMARY KEY (key, tag))')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_fast_api_cache_tags_tag ON fast_api_cache_tags (tag)')
+            # deleted items (cleared, expired or evicted) take their tags with them
+            connection.execute('CREATE TRIGGER IF NOT EXISTS fast_api_cache_delete_tags '
+                               'AFTER DELETE ON fast_api_cache BEGIN '
+                               'DELETE FROM fast_api_cache_tags WHERE key = old.key; END')
+
+    async def _run(self, func: Callable[..., R], *args) -> R:
+        def _with_connection():
+            return func(self._connect(), *args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, _with_connection)
+
+    def _ensure_flusher(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._flush_task = self._loop.create_task(self._flusher())
+        return self._loop
+
+    async def _flusher(self):
+        while True:
+            await self._wakeup.wait()
+            # let concurrent `set` calls pile up, so they are written in a single transaction
+            await asyncio.sleep(self.flush_interval_seconds)
+            self._wakeup.clear()
+            await self.flush()
+
+    def _write_batch(self,
+                     connection: sqlite3.Connection,
+                     items: list[tuple[str, str, int, int]],
+                     tags: list[tuple[str, str]],
+                     touches: list[tuple[int, str]]):
+        with connection:
+            connection.executemany(self.UPSERT_SQL, items)
+            connection.executemany(self.DELETE_KEY_TAGS_SQL, [(key,) for key, *_ in items])
+            connection.executemany(self.INSERT_KEY_TAG_SQL, tags)
+            connection.executemany(self.TOUCH_SQL, touches)
+
+    async def flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            touched, self._touched = self._touched, {}
+        if not pending and not touched:
+            return
+        now = self._now()
+        try:
+            await self._run(
+                self._write_batch,
+                [(key, value, ttl_ts, now) for key, (value, ttl_ts, _) in pending.items()],
+                [(key, tag) for key, (*_, tags) in pending.items() for tag in tags],
+                [(accessed_ts, key) for key, accessed_ts in touched.items() if key not in pending],
+            )
+        except Exception:
+            logger.warning('Error flushing %d cache items to the backend:', len(pending), exc_info=True)
+
+    def touch(self, key: str):
+        """record an access to `key`, access times are written along with the next batch of writes"""
+        with self._pending_lock:
+            self._touched[key] = self._now()
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+        await self.flush()
+        if self._connection is not None:
+            await self._run(lambda connection: connection.close())
+            self._connection = None
+
+    def _get_row(self, connection: sqlite3.Connection, key: str):
+        row = connection.execute(self.SELECT_SQL, (key,)).fetchone()
+        if row and row[1] < self._now():
+            with connection:
+                connection.execute(self.DELETE_EXPIRED_SQL, (key, self._now()))
+            return None
+        return row
+
+    async def get_with_ttl(self, key: str) -> tuple[int, str | None]:
+        with self._pending_lock:
+            pending = self._pending.get(key, None)
+        if pending is not None:
+            data, ttl_ts, _ = pending
+        elif row := await self._run(self._get_row, key):
+            data, ttl_ts = row
+        else:
+            return 0, None
+
+        if ttl_ts < self._now():
+            return 0, None
+        self.touch(key)
+        return ttl_ts - self._now(), data
+
+    async def get(self, key: str):
+        _, data = await self.get_with_ttl(key)
+        return data
+
+    def _select_tag_keys(self, connection: sqlite3.Connection, tag: str):
+        return [key for key, in connection.execute(self.SELECT_TAG_KEYS_SQL, (tag,))]
+
+    async def get_tagged_keys(self, tag: str) -> set[str]:
+        with self._pending_lock:
+            keys = {key for key, (*_, tags) in self._pending.items() if tag in tags}
+        return keys.union(await self._run(self._select_tag_keys, tag))
+
+    async def set(self, key: str, value: str, expire: int = None, tags: Iterable[str] = None):
+        """buffer a cache item (replacing its tags), to be upserted by the next batch."""
+
+        with self._pending_lock:
+            self._pending[key] = (value, self._now() + int(expire or 0), frozenset(tags or ()))
+
+        if self._ensure_flusher() is not asyncio.get_running_loop():
+            # called from an update task's event loop (worker thread), write through
+            await self.flush()
+            return
+
+        self._wakeup.set()
+
+    def _delete(self, connection: sqlite3.Connection, namespace: str = None, key: str = None, tag: str = None):
+        with connection:
+            if namespace:
+                return connection.execute(self.DELETE_NAMESPACE_SQL, (len(namespace), namespace)).rowcount
+            if key:
+                return connection.execute(self.DELETE_SQL, (key,)).rowcount
+            if tag:
+                return connection.execute(self.DELETE_TAG_SQL, (tag,)).rowcount
+        return 0
+
+    def _sweep(self,
+               connection: sqlite3.Connection,
+               max_rows: int,
+               max_size_bytes: int,
+               batch_size: int):
+        purged = evicted = 0
+
+        # each batch is its own short transaction, so readers are never blocked for long
+        while True:
+            with connection:
+                count = connection.execute(self.PURGE_EXPIRED_SQL, (self._now(), batch_size)).rowcount
+            purged += count
+            if count < batch_size:
+                break
+
+        def _size():
+            page_size, = connection.execute('PRAGMA page_size').fetchone()
+            page_count, = connection.execute('PRAGMA page_count').fetchone()
+            freelist_count, = connection.execute('PRAGMA freelist_count').fetchone()
+            return (page_count - freelist_count) * page_size
+
+        rows, = connection.execute('SELECT COUNT(*) FROM fast_api_cache').fetchone()
+        while rows:
+            if max_rows and rows > max_rows:
+                batch = min(batch_size, rows - max_rows)
+            elif max_size_bytes and (size := _size()) > max_size_bytes:
+                # evict about as many rows as the overflowing share of the size
+                batch = min(batch_size, max(1, rows * (size - max_size_bytes) // size))
+            else:
+                break
+            with connection:
+                count = connection.execute(self.EVICT_LRU_SQL, (batch,)).rowcount
+            evicted += count
+            rows -= count
+            if not count:
+                break
+
+        auto_vacuum, = connection.execute('PRAGMA auto_vacuum').fetchone()
+        if auto_vacuum != 2:
+            # switching an existing database to incremental auto-vacuum takes a single full vacuum
+            connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            connection.execute('VACUUM')
+        # `execute` would only step once, freeing a single page
+        connection.executescript('PRAGMA incremental_vacuum;')
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        return CacheSweepResult(
+            purged=purged,
+            evicted=evicted,
+            rows=rows,
+            size_bytes=_size(),
+        )
+
+    async def sweep(self, max_rows: int = 0, max_size_bytes: int = 0, batch_size: int = 500):
+        """
+        Purge expired items, then evict the least recently used items until
+        the cache fits in `max_rows` and `max_size_bytes` (`0` means unbounded), then reclaim free pages.
+        """
+
+        await self.flush()
+        return await self._run(self._sweep, max_rows, max_size_bytes, batch_size)
+
+    async def clear(self, namespace: str = None, key: str = None, tag: str = None) -> int:
+        """clear the items matching `namespace` (key prefix), `key` or `tag`, in that order of precedence"""
+
+        count = 0
+        with self._pending_lock:
+            for pending_key, (*_, tags) in list(self._pending.items()):
+                if (
+                    (namespace and pending_key.startswith(namespace))
+                    or (not namespace and key and pending_key == key)
+                    or (not namespace and not key and tag and tag in tags)
+                ):
+                    self._pending.pop(pending_key)
+                    count += 1
+
+        return count + await self._run(self._delete, namespace, key, tag)
+
+
+@dataclass
+class _MemoryItem:
+    data: str
+    ttl_ts: int
+    value: Any = _MISSING
+
+
+class TieredBackend(Backend):
+    """
+    Bounded in-memory LRU tier (L1) in front of a persistent backend (L2).
+
+    - hits are served from memory, together with their decoded value (see `get_decoded_with_ttl`)
+    - writes go through both tiers, `clear` invalidates both tiers
+    - items expire from L1 with the same TTL they were stored with
+    """
+
+    def __init__(self, l2: Backend, max_items: int = 512):
+        self.l2 = l2
+        self.max_items = max_items
+        self._items: OrderedDict[str, _MemoryItem] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _now():
+        return int(time.time())
+
+    def _get_item(self, key: str):
+        with self._lock:
+            item = self._items.get(key, None)
+            if item is None:
+                return None
+            if item.ttl_ts < self._now():
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return item
+
+    def _set_item(self, key: str, data: str, ttl_ts: int):
+        item = _MemoryItem(data=data, ttl_ts=ttl_ts)
+        with self._lock:
+            self._items[key] = item
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return item
+
+    async def _get_or_load(self, key: str):
+        if item := self._get_item(key):
+            if touch := getattr(self.l2, 'touch', None):
+                touch(key)
+            return item
+        ttl, data = await self.l2.get_with_ttl(key)
+        if data is None:
+            return None
+        return self._set_item(key, data, self._now() + ttl)
+
+    async def get_with_ttl(self, key: str) -> tuple[int, str | None]:
+        if item := await self._get_or_load(key):
+            return item.ttl_ts - self._now(), item.data
+        return 0, None
+
+    async def get_decoded_with_ttl(self, key: str, decode: Callable[[str], Any]) -> tuple[int, str | None, Any]:
+        """same as `get_with_ttl`, but also returns `decode(data)`, decoding each stored item only once."""
+
+        if item := await self._get_or_load(key):
+            if item.value is _MISSING:
+                item.value = decode(item.data)
+            return item.ttl_ts - self._now(), item.data, item.value
+        return 0, None, None
+
+    async def get(self, key: str):
+        _, data = await self.get_with_ttl(key)
+        return data
+
+    async def set(self, key: str, value: str, expire: int = None, tags: Iterable[str] = None):
+        self._set_item(key, value, self._now() + int(expire or 0))
+        if tags:
+            await self.l2.set(key, value, expire, tags=tags)
+        else:
+            await self.l2.set(key, value, expire)
+
+    async def clear(self, namespace: str = None, key: str = None, tag: str = None) -> int:
+        # L2 keeps the tags, it knows which items to drop from memory
+        tagged_keys = await self.l2.get_tagged_keys(tag) if tag and not namespace and not key else set()
+
+        with self._lock:
+            if namespace:
+                for item_key in [k for k in self._items if k.startswith(namespace)]:
+                    self._items.pop(item_key)
+            elif key:
+                self._items.pop(key, None)
+            for item_key in tagged_keys:
+                self._items.pop(item_key, None)
+
+        if tag:
+            return await self.l2.clear(namespace, key, tag=tag)
+        return await self.l2.clear(namespace, key)
+
+
+@dataclass
+class CacheSweeperStats:
+    runs: int = 0
+    purged: int = 0
+    evicted: int = 0
+    rows: int | None = None
+    size_bytes: int | None = None
+    last_run_at: datetime | None = None
+    last_duration_seconds: float | None = None
+    last_error: str | None = None
+
+
+class CacheSweeper(metaclass=Singleton):
+    """
+    Background maintenance of the SQLite cache.
+
+    Every `interval_seconds` it purges expired items in batches, enforces the row count/size caps
+    by evicting the least recently used items, and runs an incremental vacuum.
+    """
+
+    def __init__(self):
+        self.stats = CacheSweeperStats()
+        self._task: asyncio.Task | None = None
+
+    def start(self,
+              backend: AsyncSQLiteBackend,
+              interval_seconds: float,
+              max_rows: int = 0,
+              max_size_bytes: int = 0):
+        if interval_seconds <= 0:
+            logger.info('Cache sweeper disabled')
+            return None
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(
+                self._run(backend, interval_seconds, max_rows, max_size_bytes)
+            )
+        return self._task
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def sweep(self, backend: AsyncSQLiteBackend, max_rows: int = 0, max_size_bytes: int = 0):
+        start_t = time.monotonic()
+        self.stats.runs += 1
+        self.stats.last_run_at = datetime.now(timezone.utc)
+        try:
+            res = await backend.sweep(
+                max_rows=max_rows,
+                max_size_bytes=max_size_bytes,
+            )
+            self.stats.purged += res.purged
+            self.stats.evicted += res.evicted
+            self.stats.rows = res.rows
+            self.stats.size_bytes = res.size_bytes
+            self.stats.last_error = None
+            logger.info('Cache sweep: purged %d expired items, evicted %d items, %d items left (%d bytes)',
+                        res.purged, res.evicted, res.rows, res.size_bytes)
+
+        except Exception as exc:
+            self.stats.last_error = str(exc)
+            logger.exception('Error sweeping the cache')
+
+        finally:
+            self.stats.last_duration_seconds = time.monotonic() - start_t
+
+    async def _run(self, backend: AsyncSQLiteBackend, interval_seconds: float, max_rows: int, max_size_bytes: int):
+        while True:
+            await self.sweep(backend, max_rows, max_size_bytes)
+            await asyncio.sleep(interval_seconds)
@@ -27,6 +27,39 @@ class DiscoverStrategyEnum(StrEnum):
         return self is self.OPT_OUT
 
 
+class DockerBackendEnum(StrEnum):
+    CLI = 'cli'
+    ENGINE_API = 'engine-api'
+
+    def is_cli(self):
+        return self is self.CLI
+
+    def is_engine_api(self):
+        return self is self.ENGINE_API
+
+
+class RegistryBackendEnum(StrEnum):
+    NATIVE = 'native'
+    REGCTL = 'regctl'
+
+    def is_native(self):
+        return self is self.NATIVE
+
+    def is_regctl(self):
+        return self is self.REGCTL
+
+
+class UpdateDetectionEnum(StrEnum):
+    CREATED = 'created'
+    DIGEST = 'digest'
+
+    def is_created(self):
+        return self is self.CREATED
+
+    def is_digest(self):
+        return self is self.DIGEST
+
+
 class AutoUpdaterSettings(BaseSettings, CamelCaseAliasedBaseModel):
     model_config = SettingsConfigDict(env_prefix='AUTO_UPDATER_')
 
@@ -43,10 +76,19 @@ class ServerSettings(BaseSettings, CamelCaseAliasedBaseModel):
     model_config = SettingsConfigDict(env_prefix='SERVER_')
 
     cache_control_max_age: Interval = '1d'
+    cache_max_staleness: Interval = '1h'
+    cache_max_rows: int = 10000
+    cache_max_size_mb: float = 100
+    cache_memory_max_items: int = 512
+    cache_sweep_interval: Interval = '1h'
     discovery_strategy: DiscoverStrategyEnum = DiscoverStrategyEnum.OPT_OUT
+    docker_api_max_connections: int = 10
+    docker_backend: DockerBackendEnum = DockerBackendEnum.CLI
+    docker_socket_path: str = '/var/run/docker.sock'
     dryrun: bool = False
     enabled_label_field_name: str = 'com.loolzzz.docking-station.enabled'
     ignore_compose_stack_name_keywords: list[str] = Field(default_factory=lambda: ['devcontainer'])
+    insecure_registries: list[str] = Field(default_factory=list)
     possible_homepage_labels: list[str] = Field(default_factory=lambda: ['org.label-schema.url',
                                                                          'org.opencontainers.image.url',
                                                                          'org.opencontainers.image.source'])
@@ -54,16 +96,53 @@ class ServerSettings(BaseSettings, CamelCaseAliasedBaseModel):
                                                                               'org.opencontainers.image.version'])
     python_on_whales__ignored_image_prefixes: list[str] = Field(default_factory=lambda: ['docker.io/',
                                                                                          'docker.io/library/'])
+    registry_backend: RegistryBackendEnum = RegistryBackendEnum.REGCTL
+    registry_lookups_burst: int = 20
+    registry_lookups_per_second: float = 10
+    registry_max_concurrent_lookups: int = 8
+    registry_max_connections: int = 4
+    registry_ratelimit_reserve: int = 10
+    task_gc_interval: Interval = '1m'
+    task_log_dir: str = '/app/data/tasks'
+    task_log_memory_lines: int = 1000
+    task_max_count: int = 100
+    task_retention: Interval = '5m'
     time_until_update_is_mature: Interval = '1w'
+    update_detection: UpdateDetectionEnum = UpdateDetectionEnum.CREATED
+    update_max_concurrent_pulls: int = 4
+    update_max_workers: int = 2
+    update_staging: bool = False
+    update_staging_interval: Interval = '6h'
+    watch_docker_events: bool = False
 
     @property
     def cache_control_max_age_seconds(self):
         return self.cache_control_max_age.total_seconds()
 
+    @property
+    def cache_max_staleness_seconds(self):
+        return self.cache_max_staleness.total_seconds()
+
+    @property
+    def cache_max_size_bytes(self):
+        return int(self.cache_max_size_mb * 1024 * 1024)
+
+    @property
+    def cache_sweep_interval_seconds(self):
+        return self.cache_sweep_interval.total_seconds()
+
+    @property
+    def task_gc_interval_seconds(self):
+        return self.task_gc_interval.total_seconds()
+
     @property
     def time_until_update_is_mature_seconds(self):
         return self.time_until_update_is_mature.total_seconds()
 
+    @property
+    def update_staging_interval_seconds(self):
+        return self.update_staging_interval.total_seconds()
+
     @property
     def ignore_compose_stack_name_pattern(self):
         return re.compile(
@@ -75,6 +154,7 @@ class ServerSettings(BaseSettings, CamelCaseAliasedBaseModel):
     @field_validator(
         'possible_homepage_labels',
         'ignore_compose_stack_name_keywords',
+        'insecure_registries',
         mode='before'
     )
     @classmethod
@@ -1,11 +1,26 @@
+import asyncio
+import time
+from bisect import bisect_right
+from collections import deque
 from dataclasses import dataclass, field
-from datetime import datetime, timedelta
-from threading import Thread
-from typing import Literal, NewType, NotRequired, TypedDict, Unpack
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from logging import getLogger
+from pathlib import Path
+from threading import Lock, Thread
+from typing import (Callable, Iterable, Literal, NewType, NotRequired,
+                    TypedDict, Unpack)
+from uuid import uuid4
 
-from .schemas import MessageDict
+import orjson
+
+from .schemas import MessageDict, TaskStateEnum, UpdatePriorityEnum
+from .settings import get_app_settings
 from .utils import Singleton
 
+logger = getLogger(__name__)
+app_settings = get_app_settings()
+
 StackStr = NewType('StackStr', str)
 _ServiceStr = NewType('_ServiceStr', str)
 ServiceStr = _ServiceStr | Literal['*']
@@ -14,30 +29,223 @@ MessageList = list[MessageDict]
 
 
 class TaskStoreItemDict(TypedDict):
-    worker: Thread
+    worker: NotRequired[Thread]
     messages: NotRequired[list[MessageDict]]
     timestamp: NotRequired[datetime]
+    priority: NotRequired[UpdatePriorityEnum]
+
+
+class TaskLog:
+    """
+    Append-only message log of a task, with a flat memory footprint.
+
+    The most recent `max_lines` messages are kept in memory, older ones are spilled in chunks
+    to an NDJSON file under `task_log_dir`. Offset based reads work across both.
+    """
+
+    def __init__(self,
+                 messages: Iterable[MessageDict] = (),
+                 max_lines: int = None,
+                 spill_dir: str | Path = None):
+        self.max_lines = max(max_lines or app_settings.server.task_log_memory_lines, 1)
+        self.spill_dir = Path(spill_dir or app_settings.server.task_log_dir)
+        self.path: Path | None = None
+        self._lock = Lock()
+        self._recent: deque[MessageDict] = deque()
+        self._spilled = 0
+        self._spilled_bytes = 0
+        self._spill_failed = False
+        # `(index of the first message, byte offset)` of every spilled chunk
+        self._chunks: list[tuple[int, int]] = []
+
+        for message in messages:
+            self.append(message)
+
+    def __len__(self):
+        return self._spilled + len(self._recent)
+
+    @property
+    def in_memory(self):
+        return len(self._recent)
+
+    @property
+    def spilled(self):
+        return self._spilled
+
+    @property
+    def spilled_bytes(self):
+        return self._spilled_bytes
+
+    def __iter__(self):
+        return iter(self.read())
+
+    def __getitem__(self, item: int | slice):
+        if isinstance(item, slice) and item.step is None and item.stop is None:
+            return self.read(item.start)
+        return self.read()[item]
+
+    @property
+    def _chunk_lines(self):
+        return max(self.max_lines // 4, 1)
+
+    def append(self, message: MessageDict):
+        with self._lock:
+            self._recent.append(message)
+            if not self._spill_failed and len(self._recent) >= self.max_lines + self._chunk_lines:
+                self._spill(self._chunk_lines)
+
+    def _spill(self, count: int):
+        messages = [self._recent.popleft() for _ in range(count)]
+        data = b''.join(orjson.dumps(message) + b'\n' for message in messages)
+        try:
+            if self.path is None:
+                self.spill_dir.mkdir(parents=True, exist_ok=True)
+                self.path = self.spill_dir / f'{uuid4().hex}.ndjson'
+            with open(self.path, 'ab') as fp:
+                fp.write(data)
+
+        except OSError:
+            # keep everything in memory from here on
+            logger.exception('Error spilling task messages to %s', self.spill_dir)
+            self._recent.extendleft(reversed(messages))
+            self._spill_failed = True
+            return
+
+        self._chunks.append((self._spilled, self._spilled_bytes))
+        self._spilled += count
+        self._spilled_bytes += len(data)
+
+    def _read_spilled(self, offset: int):
+        first, position = self._chunks[bisect_right(self._chunks, (offset, float('inf'))) - 1]
+        with open(self.path, 'rb') as fp:
+            fp.seek(position)
+            return [
+                orjson.loads(line)
+                for line in islice(fp, offset - first, self._spilled - first)
+            ]
+
+    def read(self, offset: int | None = 0):
+        """Messages from `offset` onwards, negative offsets count from the end"""
+
+        with self._lock:
+            offset = offset or 0
+            if offset < 0:
+                offset = max(len(self) + offset, 0)
+            if offset >= self._spilled:
+                return list(islice(self._recent, offset - self._spilled, None))
+            return self._read_spilled(offset) + list(self._recent)
+
+    def remove(self):
+        """Delete the spill file, if any"""
+
+        with self._lock:
+            if self.path is not None:
+                self.path.unlink(missing_ok=True)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
 
 
 @dataclass
 class TaskStoreItem:
+    """
+    An update task, either running on its own `worker` thread
+    or (without a `worker`) queued on the `UpdateScheduler`'s worker pool.
+    """
+
     worker: Thread | None = None
-    messages: list[MessageDict] = field(default_factory=list)
+    messages: TaskLog = field(default_factory=TaskLog)
     timestamp: datetime = field(default_factory=datetime.now)
+    priority: UpdatePriorityEnum = UpdatePriorityEnum.HIGH
+    state: TaskStateEnum = TaskStateEnum.QUEUED
+    queued_at: datetime = field(default_factory=datetime.now)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    error: Exception | None = None
+    _lock: Lock = field(default_factory=Lock, init=False, repr=False)
+    _waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = field(default_factory=set, init=False, repr=False)
+    _done_callbacks: list[Callable[['TaskStoreItem'], None]] = field(default_factory=list, init=False, repr=False)
+
+    def __post_init__(self):
+        if not isinstance(self.messages, TaskLog):
+            self.messages = TaskLog(self.messages)
+
+    def _notify(self):
+        """wake up the `wait_for_messages` callers, messages are appended from the worker threads"""
+        with self._lock:
+            waiters, self._waiters = self._waiters, set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
 
     def append_message(self, value: MessageDict):
         self.messages.append(value)
         self.timestamp = datetime.now()
+        self._notify()
         return self.messages
 
+    @property
+    def done(self):
+        return self.state is TaskStateEnum.FINISHED
+
+    def set_running(self):
+        self.state = TaskStateEnum.RUNNING
+        self.started_at = self.timestamp = datetime.now()
+
+    def set_done(self, error: Exception | None = None):
+        with self._lock:
+            self.error = error
+            self.state = TaskStateEnum.FINISHED
+            self.finished_at = self.timestamp = datetime.now()
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        self._notify()
+        for callback in callbacks:
+            self._run_done_callback(callback)
+
+    def add_done_callback(self, callback: Callable[['TaskStoreItem'], None]):
+        """`callback(task)` runs once the task is done, on the thread finishing it (or right away if it already is)"""
+        with self._lock:
+            if not self.done:
+                self._done_callbacks.append(callback)
+                return
+        self._run_done_callback(callback)
+
+    def _run_done_callback(self, callback: Callable[['TaskStoreItem'], None]):
+        try:
+            callback(self)
+        except Exception:
+            logger.exception('Error running task done callback')
+
+    async def wait_for_messages(self, offset: int = 0, timeout: float | None = None):
+        """Wait until there are messages past `offset` or the task is done, returns `False` on timeout"""
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self.done or len(self.messages) > offset:
+                return True
+            waiter = (loop, future)
+            self._waiters.add(waiter)
+
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
     def is_worker_alive(self):
-        return (
-            self.worker is not None
-            and self.worker.is_alive()
-        )
+        if self.worker is None:
+            return not self.done
+        return self.worker.is_alive()
 
     def join(self):
-        return self.worker.join()
+        """Wait for the `worker` thread, a failed task's exception is kept in `error`"""
+        if self.worker is not None:
+            self.worker.join()
 
     def start(self):
         if self.worker:
@@ -45,10 +253,29 @@ class TaskStoreItem:
         raise ValueError('Worker not set')
 
 
+@dataclass
+class TaskStoreStats:
+    runs: int = 0
+    collected: int = 0
+    last_run_at: datetime | None = None
+    last_duration_seconds: float | None = None
+
+
 @dataclass
 class TaskStore(metaclass=Singleton):
-    ttl: timedelta = field(default_factory=lambda: timedelta(seconds=5))
+    """
+    Update tasks by `(stack, service)`, a task updating several services is stored under each of their keys.
+
+    Finished tasks are kept for `ttl` after their last message. Expired tasks are dropped when looked up
+    and by a background collection every `task_gc_interval` (unless it is `0`), which also drops the oldest
+    finished tasks once there are more than `max_tasks`.
+    """
+
+    ttl: timedelta = field(default_factory=lambda: app_settings.server.task_retention)
+    max_tasks: int = field(default_factory=lambda: app_settings.server.task_max_count)
+    stats: TaskStoreStats = field(default_factory=TaskStoreStats)
     _store: dict[StoreKey, TaskStoreItem] = field(default_factory=dict)
+    _task: asyncio.Task | None = field(default=None, init=False, repr=False)
 
     def __contains__(self, key: StoreKey):
         return bool(
@@ -66,9 +293,39 @@ class TaskStore(metaclass=Singleton):
                 self.create_task(key, **item)
             case TaskStoreItem():
                 self._store[key] = item
+                self._enforce_max_tasks()
             case _:
                 raise ValueError('Invalid type')
 
+    def _is_expired(self, item: TaskStoreItem, now: datetime):
+        return not item.is_worker_alive() and now - item.timestamp > self.ttl
+
+    def _drop(self, keys: Iterable[StoreKey]):
+        """Drop the keys, deleting the spill files of the tasks which are no longer stored under any key"""
+
+        dropped = {
+            id(item): item
+            for key in keys
+            if (item := self._store.pop(key, None)) is not None
+        }
+        for item in self._store.values():
+            dropped.pop(id(item), None)
+        for item in dropped.values():
+            item.messages.remove()
+        return len(dropped)
+
+    @property
+    def key_count(self):
+        return len(self._store)
+
+    def tasks(self):
+        """The stored tasks, each one once"""
+        return list({id(item): item for item in self._store.values()}.values())
+
+    def _enforce_max_tasks(self):
+        if self.max_tasks and len(self._store) > self.max_tasks and len(self.tasks()) > self.max_tasks:
+            self.collect()
+
     def get(self, key: tuple[StackStr, ServiceStr], default: TaskStoreItem | None = None):
         item = None
         if key in self._store:
@@ -76,9 +333,12 @@ class TaskStore(metaclass=Singleton):
         if (key[0], '*') in self._store:
             item = self._store[(key[0], '*')]
 
-        if (not item or (not item.is_worker_alive()
-                         and datetime.now() - item.timestamp > self.ttl)):
-            self._store.pop(key, None)
+        if not item or self._is_expired(item, datetime.now()):
+            self._drop([
+                store_key
+                for store_key in (key, (key[0], '*'))
+                if item and self._store.get(store_key, None) is item
+            ])
             return default
 
         return item
@@ -86,4 +346,75 @@ class TaskStore(metaclass=Singleton):
     def create_task(self, key: StoreKey, **kwargs: Unpack[TaskStoreItemDict]):
         item = TaskStoreItem(**kwargs)
         self._store[key] = item
+        self._enforce_max_tasks()
         return item
+
+    def collect(self):
+        """
+        Drop the expired tasks, then the least recently active finished tasks above `max_tasks`.
+        Queued and running tasks are never dropped. Returns the number of dropped tasks.
+        """
+
+        start_t = time.monotonic()
+        now = datetime.now()
+        expired = {
+            id(item)
+            for item in self._store.values()
+            if self._is_expired(item, now)
+        }
+
+        if self.max_tasks:
+            tasks = [item for item in self.tasks() if id(item) not in expired]
+            finished = sorted(
+                (item for item in tasks if not item.is_worker_alive()),
+                key=lambda item: item.timestamp,
+            )
+            for item in finished[:max(len(tasks) - self.max_tasks, 0)]:
+                expired.add(id(item))
+
+        count = self._drop([
+            key
+            for key, item in self._store.items()
+            if id(item) in expired
+        ])
+
+        self.stats.runs += 1
+        self.stats.collected += count
+        self.stats.last_run_at = datetime.now(timezone.utc)
+        self.stats.last_duration_seconds = time.monotonic() - start_t
+        if count:
+            logger.info('Task store: dropped %d tasks, %d tasks left', count, len(self.tasks()))
+        return count
+
+    def start(self, interval_seconds: float):
+        if self._task is None or self._task.done():
+            self._remove_orphaned_logs()
+            if interval_seconds <= 0:
+                logger.info('Task store collection disabled')
+                return None
+            self._task = asyncio.create_task(self._run(interval_seconds))
+        return self._task
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self, interval_seconds: float):
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                self.collect()
+            except Exception:
+                logger.exception('Error collecting tasks')
+
+    def _remove_orphaned_logs(self):
+        """spill files left over by a previous run"""
+
+        live = {item.messages.path for item in self._store.values()}
+        for path in Path(app_settings.server.task_log_dir).glob('*.ndjson'):
+            if path not in live:
+                path.unlink(missing_ok=True)
@@ -27,6 +27,8 @@ def tryparse_float(value):
 
 
 def subprocess_stream_generator(cmd: list[str]):
+    """Yield the non-empty output lines of `cmd`, raises once it exits with an error"""
+
     process = subprocess.Popen(
         cmd,
         stdout=subprocess.PIPE,
@@ -41,3 +43,6 @@ def subprocess_stream_generator(cmd: list[str]):
                  if (ll := l.strip())]
         for i in lines:
             yield i
+
+    if returncode := process.wait():
+        raise RuntimeError(f'{" ".join(cmd[:2])} exited with code {returncode}')
@@ -381,8 +381,14 @@ export const usePollUpdateComposeStackTask = <TData extends DockerServiceUpdateW
   }, [isTaskRunning, startPolling])
 
   useEffect(() => {
-    if (lastMessage?.stage.toLowerCase() === 'finished') {
+    const stage = lastMessage?.stage.toLowerCase()
+    if (stage === 'finished') {
       onSuccess()
+    } else if (stage === 'error') {
+      // the task failed, its output (ending with the error) stays in the message history
+      setEnabled(false)
+      queryClient.invalidateQueries({ queryKey: createTaskPartialQueryKey })
+      onError(new Error(lastMessage?.message ?? `'${stackName}' update failed`))
     }
     // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [lastMessage])
@@ -11,11 +11,27 @@ export const apiRoutes = {
   getComposeStack: (stack: string) => `api/stacks/${stack}`,
   /** `GET` */
   getComposeService: (stack: string, service: string) => `api/stacks/${stack}/${service}`,
+  /** `GET` */
+  listComposeStackChanges: 'api/stacks/changes',
+  /** `GET` (server-sent events) */
+  streamComposeStackChanges: 'api/stacks/changes/events',
 
   /** `POST` */
   createUpdateComposeStackServiceTask: (stack: string, service: string) => `api/stacks/${stack}/${service}/task`,
   /** `POST` */
   createComposeBatchUpdateTask: 'api/stacks/batch_update',
+  /** `POST` */
+  stageComposeImages: 'api/stacks/stage',
+  /** `GET` */
+  listStagedComposeImages: 'api/stacks/staged',
   /** `GET` */
   pollUpdateComposeStackServiceTask: (stack: string, service: string) => `api/stacks/${stack}/${service}/task`,
+  /** `GET` */
+  getUpdateComposeStackServiceTaskStatus: (stack: string, service: string) => `api/stacks/${stack}/${service}/task/status`,
+  /** `GET` */
+  getTaskStoreStats: 'api/stacks/tasks/stats',
+  /** `GET` (server-sent events) */
+  streamUpdateComposeStackServiceTask: (stack: string, service: string) => `api/stacks/${stack}/${service}/task/events`,
+  /** `WebSocket` */
+  followUpdateComposeStackServiceTask: (stack: string, service: string) => `api/stacks/${stack}/${service}/task/ws`,
 }
@@ -26,6 +26,7 @@ export interface DockerImageResponse {
   imageTag: string
   latestUpdate: string
   latestVersion?: string
+  pending?: boolean
   repoLocalDigest: string
   version?: string
 }
@@ -77,10 +78,56 @@ export interface DockerStack extends DockerStackResponse {
   services: DockerContainer[]
 }
 
+export interface DockerStackChangesResponse {
+  cursor: string
+  reset: boolean
+  services: DockerContainerResponse[]
+  /** `'<stack>/<service>'` */
+  removed: string[]
+}
+
 export interface DockerServiceUpdateRequest {
   inferEnvfile?: boolean
   pruneImages?: boolean
   restartContainers?: boolean
+  priority?: 'high' | 'low'
+}
+
+export interface StagedImageResponse {
+  repoTag: string
+  state: 'pulling' | 'ready' | 'failed'
+  stacks: string[]
+  requestedAt: string
+  stagedAt: string | null
+  digest: string | null
+  checkedAt: string | null
+  error: string | null
+}
+
+export interface DockerServiceUpdateTaskStatus {
+  state: 'queued' | 'running' | 'finished'
+  priority: 'high' | 'low'
+  queuePosition: number | null
+  messages: number
+  queuedAt: string
+  startedAt: string | null
+  finishedAt: string | null
+  error: string | null
+}
+
+export interface TaskStoreStats {
+  tasks: number
+  keys: number
+  queued: number
+  running: number
+  finished: number
+  messagesInMemory: number
+  messagesSpilled: number
+  spilledBytes: number
+  gcRuns: number
+  gcCollected: number
+  gcLastRunAt: string | null
+  gcLastDurationSeconds: number | null
 }
 
 export interface DockerServiceUpdateResponse {
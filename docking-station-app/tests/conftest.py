@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the API is run from `src/app` (`uvicorn api.main:app`), import it the same way
+sys.path.insert(0, str(Path(__file__).parents[1] / 'src' / 'app'))
@@ -0,0 +1,119 @@
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from api.services import inventory
+from api.services.engine import DockerEngineClient, DockerEngineError
+
+CONTAINERS = {
+    'c1': {'Id': 'c1', 'Name': '/web'},
+    'c2': {'Id': 'c2', 'Name': '/db'},
+}
+
+
+def _fake_daemon(requests: list[web.Request]):
+    """A stand-in for the docker daemon's Engine API"""
+
+    async def list_containers(request: web.Request):
+        requests.append(request)
+        return web.json_response([{'Id': key} for key in CONTAINERS])
+
+    async def inspect_container(request: web.Request):
+        container_id = request.match_info['id']
+        if container_id == 'broken':
+            return web.json_response({'message': 'daemon exploded'}, status=500)
+        if container_id not in CONTAINERS:
+            return web.json_response({'message': f'No such container: {container_id}'}, status=404)
+        return web.json_response(CONTAINERS[container_id])
+
+    async def events(request: web.Request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for action in ('start', 'die'):
+            await response.write(json.dumps({'Type': 'container', 'Action': action}).encode() + b'\n')
+        return response
+
+    app = web.Application()
+    app.router.add_get('/containers/json', list_containers)
+    app.router.add_get('/containers/{id}/json', inspect_container)
+    app.router.add_get('/events', events)
+    return app
+
+
+def run_with_daemon(tmp_path, test):
+    """Run `test(client, requests)` against a fake daemon listening on a unix socket"""
+
+    socket_path = str(tmp_path / 'docker.sock')
+    requests: list[web.Request] = []
+
+    async def _main():
+        runner = web.AppRunner(_fake_daemon(requests))
+        await runner.setup()
+        await web.UnixSite(runner, socket_path).start()
+        client = DockerEngineClient(socket_path=socket_path, max_connections=2)
+        try:
+            return await test(client, requests)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    return asyncio.run(_main())
+
+
+def test_list_containers_encodes_filters(tmp_path):
+    async def _test(client: DockerEngineClient, requests):
+        res = await client.list_containers(all=True, filters={'label': 'com.docker.compose.project'})
+        assert [item['Id'] for item in res] == ['c1', 'c2']
+        assert requests[0].query['all'] == 'true'
+        assert json.loads(requests[0].query['filters']) == {'label': ['com.docker.compose.project']}
+
+    run_with_daemon(tmp_path, _test)
+
+
+def test_inspect_error_status(tmp_path):
+    async def _test(client: DockerEngineClient, _):
+        with pytest.raises(DockerEngineError) as exc_info:
+            await client.inspect_container('missing')
+        assert exc_info.value.status == 404
+        assert 'No such container' in exc_info.value.message
+
+    run_with_daemon(tmp_path, _test)
+
+
+def test_engine_inspect_skips_removed_objects(tmp_path):
+    async def _test(client: DockerEngineClient, _):
+        return await inventory._engine_inspect(client.inspect_container, ['c1', 'gone', 'c2'])
+
+    res = run_with_daemon(tmp_path, _test)
+    assert [item['Name'] for item in res] == ['/web', '/db']
+
+
+def test_engine_inspect_raises_other_errors(tmp_path):
+    async def _test(client: DockerEngineClient, _):
+        await inventory._engine_inspect(client.inspect_container, ['c1', 'broken'])
+
+    with pytest.raises(DockerEngineError) as exc_info:
+        run_with_daemon(tmp_path, _test)
+    assert exc_info.value.status == 500
+
+
+def test_engine_inspect_raises_on_wrong_socket(tmp_path):
+    async def _main():
+        client = DockerEngineClient(socket_path=str(tmp_path / 'nothing.sock'))
+        try:
+            await inventory._engine_inspect(client.inspect_container, ['c1'])
+        finally:
+            await client.close()
+
+    with pytest.raises(aiohttp.ClientConnectionError):
+        asyncio.run(_main())
+
+
+def test_events_stream(tmp_path):
+    async def _test(client: DockerEngineClient, _):
+        return [event['Action'] async for event in client.events(filters={'type': 'container'})]
+
+    assert run_with_daemon(tmp_path, _test) == ['start', 'die']
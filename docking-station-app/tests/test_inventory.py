@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime, timezone
+
+from api.services import inventory
+from api.services.inventory import (COMPOSE_PROJECT_LABEL, COMPOSE_SERVICE_LABEL,
+                                    ContainerRecord, ImageRecord, InventorySnapshot)
+
+CREATED_AT = datetime(2024, 5, 1, tzinfo=timezone.utc)
+SNAPSHOT = InventorySnapshot(
+    containers=[
+        ContainerRecord(
+            id='c1',
+            name='app-web-1',
+            created_at=CREATED_AT,
+            started_at=CREATED_AT,
+            image_id='sha256:web',
+            image_ref='nginx:latest',
+            labels={COMPOSE_PROJECT_LABEL: 'app', COMPOSE_SERVICE_LABEL: 'web'},
+            status='running',
+        ),
+    ],
+    images={
+        'sha256:web': ImageRecord(
+            id='sha256:web',
+            created_at=CREATED_AT,
+            repo_digests=['nginx@sha256:local'],
+            repo_tags=['nginx:latest'],
+        ),
+    },
+)
+
+
+def _failing_build_image(delay: float):
+    async def _build_image(*args, **kwargs):
+        await asyncio.sleep(delay)
+        raise RuntimeError('registry exploded')
+
+    return _build_image
+
+
+def _stream(grace_seconds: float):
+    async def _main():
+        return [item async for item in inventory.stream_compose_stacks(SNAPSHOT, grace_seconds=grace_seconds)]
+
+    return asyncio.run(_main())
+
+
+def test_stream_patches_service_whose_lookup_failed(monkeypatch):
+    monkeypatch.setattr(inventory, 'build_image', _failing_build_image(delay=0.1))
+
+    (stack_event, stack), (service_event, service) = _stream(grace_seconds=0.01)
+
+    assert (stack_event, service_event) == ('stack', 'service')
+    assert stack.services[0].image.pending
+    assert service.id == 'c1'
+    assert not service.image.pending
+    assert service.image.repo_tag == 'nginx:latest'
+
+
+def test_stream_does_not_mark_failed_lookup_pending(monkeypatch):
+    monkeypatch.setattr(inventory, 'build_image', _failing_build_image(delay=0))
+
+    (event, stack), = _stream(grace_seconds=0.5)
+
+    assert event == 'stack'
+    assert not stack.services[0].image.pending
+
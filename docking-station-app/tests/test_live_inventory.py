@@ -0,0 +1,42 @@
+from datetime import datetime, timezone
+
+from api.services import inventory
+from api.services.inventory import (COMPOSE_PROJECT_LABEL, COMPOSE_SERVICE_LABEL,
+                                    ContainerRecord, ImageRecord)
+from api.services.live_inventory import LiveInventory
+
+CREATED_AT = datetime(2024, 5, 1, tzinfo=timezone.utc)
+IMAGE = ImageRecord(id='sha256:web', created_at=CREATED_AT, repo_tags=['nginx:latest'])
+
+
+def _stack(statuses: list[str]):
+    containers = [
+        ContainerRecord(
+            id=status,
+            name=f'app-{status}-1',
+            created_at=CREATED_AT,
+            started_at=CREATED_AT,
+            image_id=IMAGE.id,
+            image_ref='nginx:latest',
+            labels={COMPOSE_PROJECT_LABEL: 'app', COMPOSE_SERVICE_LABEL: status},
+            status=status,
+        )
+        for status in statuses
+    ]
+    return inventory._build_stack('app', containers, [
+        inventory._build_container(container, inventory.local_image(IMAGE, container.image_tag))
+        for container in containers
+    ])
+
+
+def test_list_stacks_keeps_the_states_docker_ps_lists(monkeypatch):
+    live_inventory = LiveInventory()
+    monkeypatch.setattr(live_inventory, '_stacks', {'app': _stack(['running', 'paused', 'restarting', 'exited'])})
+
+    [stack] = live_inventory.list_stacks()
+    assert sorted(service.status for service in stack.services) == ['paused', 'restarting', 'running']
+    assert (stack.running, stack.paused, stack.restarting, stack.exited) == (1, 1, 1, 0)
+
+    [stack] = live_inventory.list_stacks(include_stopped=True)
+    assert len(stack.services) == 4
+    assert stack.exited == 1
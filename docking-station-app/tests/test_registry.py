@@ -0,0 +1,247 @@
+import asyncio
+import hashlib
+import json
+
+import pytest
+from aiohttp import web
+
+from api.services import registry
+from api.services.registry import (ImageReference, RegistryClient,
+                                   RegistryError, TokenCache)
+
+INDEX_MEDIA_TYPE = 'application/vnd.oci.image.index.v1+json'
+MANIFEST_MEDIA_TYPE = 'application/vnd.oci.image.manifest.v1+json'
+CONFIG = json.dumps({
+    'architecture': 'amd64',
+    'created': '2024-05-01T00:00:00Z',
+    'config': {'Labels': {'org.opencontainers.image.version': '1.2.3'}},
+}).encode()
+CONFIG_DIGEST = f'sha256:{hashlib.sha256(CONFIG).hexdigest()}'
+
+
+def _manifest(platform: dict):
+    return json.dumps({
+        'mediaType': MANIFEST_MEDIA_TYPE,
+        'config': {'digest': CONFIG_DIGEST},
+        'layers': [],
+        'platform': platform,
+    }).encode()
+
+
+MANIFESTS = {
+    'sha256:amd64': _manifest({'os': 'linux', 'architecture': 'amd64'}),
+    'sha256:arm64': _manifest({'os': 'linux', 'architecture': 'arm64'}),
+    'sha256:attestation': _manifest({'os': 'unknown', 'architecture': 'unknown'}),
+}
+
+
+def _index(*digests: str):
+    return json.dumps({
+        'mediaType': INDEX_MEDIA_TYPE,
+        'manifests': [
+            {'digest': digest, 'platform': json.loads(MANIFESTS[digest])['platform']}
+            for digest in digests
+        ],
+    }).encode()
+
+
+class FakeRegistry:
+    """A stand-in for an OCI registry with bearer token auth"""
+
+    def __init__(self):
+        self.tags = {
+            'multi': _index('sha256:attestation', 'sha256:arm64', 'sha256:amd64'),
+            'foreign': _index('sha256:attestation', 'sha256:arm64'),
+        }
+        self.valid_tokens: set[str] = set()
+        self.token_requests = 0
+        self.token_delay = 0
+        self.requests: list[tuple[str, str]] = []
+        self.head_digest_header = True
+        self.base_url = None
+
+    async def token(self, request: web.Request):
+        self.token_requests += 1
+        await asyncio.sleep(self.token_delay)
+        token = f'token-{self.token_requests}'
+        self.valid_tokens.add(token)
+        return web.json_response({'token': token, 'expires_in': 300})
+
+    async def manifest(self, request: web.Request):
+        self.requests.append((request.method, request.match_info['reference']))
+        if request.headers.get('Authorization', '').removeprefix('Bearer ') not in self.valid_tokens:
+            return web.Response(status=401, headers={
+                'WWW-Authenticate': f'Bearer realm="{self.base_url}/token",service="fake"',
+            })
+
+        reference = request.match_info['reference']
+        body = self.tags.get(reference, None) or MANIFESTS.get(reference, None)
+        if body is None:
+            return web.json_response({'errors': [{'code': 'MANIFEST_UNKNOWN'}]}, status=404)
+
+        headers = {'Content-Type': json.loads(body)['mediaType']}
+        if self.head_digest_header:
+            headers['Docker-Content-Digest'] = f'sha256:{hashlib.sha256(body).hexdigest()}'
+        if request.method == 'HEAD':
+            return web.Response(headers=headers)
+        return web.Response(body=body, headers=headers)
+
+    async def blob(self, request: web.Request):
+        return web.Response(body=CONFIG)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/token', self.token)
+        app.router.add_route('*', '/v2/{repository:.+}/manifests/{reference}', self.manifest)
+        app.router.add_get('/v2/{repository:.+}/blobs/{digest}', self.blob)
+        return app
+
+
+@pytest.fixture(autouse=True)
+def local_platform(monkeypatch):
+    monkeypatch.setattr(registry, '_local_platform', lambda: ('linux', 'amd64'))
+
+
+def run_with_registry(test):
+    """Run `test(client, fake, registry_host)` against a fake registry on a local port"""
+
+    fake = FakeRegistry()
+
+    async def _main():
+        runner = web.AppRunner(fake.app())
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        host = f'127.0.0.1:{port}'
+        fake.base_url = f'http://{host}'
+        client = RegistryClient(max_connections=4, insecure_registries=[host])
+        try:
+            return await test(client, fake, host)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    return asyncio.run(_main())
+
+
+def test_token_cache_expiry_margin(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(registry.time, 'monotonic', lambda: now)
+    cache = TokenCache(expiry_margin_seconds=10)
+    key = ('docker.io', 'library/redis', 'repository:library/redis:pull')
+
+    cache.set(key, 'token', expires_in=60)
+    now += 49
+    assert cache.get(key) == 'token'
+    now += 2  # within the margin of the actual expiry
+    assert cache.get(key) is None
+
+    cache.set(key, 'short', expires_in=5)  # shorter than the margin, never served
+    assert cache.get(key) is None
+
+
+def test_token_cache_shares_pending_fetch():
+    key = ('docker.io', 'library/redis', 'repository:library/redis:pull')
+    calls = 0
+
+    async def _fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return f'token-{calls}', 300
+
+    async def _main():
+        cache = TokenCache()
+        res = await asyncio.gather(*[cache.get_or_fetch(key, _fetch) for _ in range(5)])
+        return cache, res
+
+    cache, res = asyncio.run(_main())
+    assert res == ['token-1'] * 5
+    assert calls == 1
+    assert cache.misses == 1
+
+
+def test_token_cache_failed_fetch_is_not_cached():
+    key = ('docker.io', 'library/redis', 'repository:library/redis:pull')
+    calls = 0
+
+    async def _fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        if calls == 1:
+            raise RegistryError(503, 'unavailable')
+        return 'token', 300
+
+    async def _main():
+        cache = TokenCache()
+        res = await asyncio.gather(*[cache.get_or_fetch(key, _fetch) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(item, RegistryError) for item in res)
+        return await cache.get_or_fetch(key, _fetch)
+
+    assert asyncio.run(_main()) == 'token'
+    assert calls == 2
+
+
+def test_concurrent_requests_share_a_token():
+    async def _test(client: RegistryClient, fake: FakeRegistry, host: str):
+        fake.token_delay = 0.05
+        return fake, await asyncio.gather(*[client.get_digest(f'{host}/app:multi') for _ in range(5)])
+
+    fake, digests = run_with_registry(_test)
+    assert len(set(digests)) == 1
+    assert fake.token_requests == 1
+
+
+def test_reauthenticates_revoked_token():
+    async def _test(client: RegistryClient, fake: FakeRegistry, host: str):
+        await client.get_digest(f'{host}/app:multi')
+        fake.valid_tokens.clear()  # revoked before its expiry
+        digest = await client.get_digest(f'{host}/app:multi')
+        return fake, digest
+
+    fake, digest = run_with_registry(_test)
+    assert digest == f'sha256:{hashlib.sha256(fake.tags["multi"]).hexdigest()}'
+    assert fake.token_requests == 2
+
+
+def test_digest_uses_head():
+    async def _test(client: RegistryClient, fake: FakeRegistry, host: str):
+        return fake, await client.get_digest(f'{host}/app:multi')
+
+    fake, digest = run_with_registry(_test)
+    assert digest == f'sha256:{hashlib.sha256(fake.tags["multi"]).hexdigest()}'
+    assert {method for method, _ in fake.requests} == {'HEAD'}
+
+
+def test_digest_falls_back_to_get():
+    async def _test(client: RegistryClient, fake: FakeRegistry, host: str):
+        fake.head_digest_header = False
+        return fake, await client.get_digest(f'{host}/app:multi')
+
+    fake, digest = run_with_registry(_test)
+    assert digest == f'sha256:{hashlib.sha256(fake.tags["multi"]).hexdigest()}'
+    assert ('GET', 'multi') in fake.requests
+
+
+def test_inspect_resolves_local_platform():
+    async def _test(client: RegistryClient, fake: FakeRegistry, host: str):
+        return fake, await client.inspect(f'{host}/app:multi')
+
+    fake, res = run_with_registry(_test)
+    assert res.config.labels['org.opencontainers.image.version'] == '1.2.3'
+    assert ('GET', 'sha256:amd64') in fake.requests
+    assert ('GET', 'sha256:attestation') not in fake.requests
+
+
+def test_platform_manifest_without_local_platform_raises():
+    async def _test(client: RegistryClient, fake: FakeRegistry, host: str):
+        with pytest.raises(RegistryError) as exc_info:
+            await client.get_platform_manifest(ImageReference.parse(f'{host}/app:foreign'))
+        return fake, exc_info.value
+
+    fake, exc = run_with_registry(_test)
+    assert exc.status == 404
+    assert 'linux/amd64' in exc.message
+    assert not any(reference.startswith('sha256:') for _, reference in fake.requests)